@@ -0,0 +1,87 @@
+# Analytics
+#
+# Overview:
+# - Vectorised stats across many athletes (groups, the whole org)
+# - Reads the daily rollups for the whole cohort in one query and works on them as NumPy arrays
+
+import datetime as dt
+import logging
+import warnings
+
+import numpy as np
+
+from rollups import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Percentile bands reported for every metric, per day
+PERCENTILES = {
+    "p10": 10,
+    "p25": 25,
+    "median": 50,
+    "p75": 75,
+    "p90": 90
+}
+
+def to_list(values, decimals=3):
+    '''
+    Convert a float array to a JSON-friendly list, with NaN as None.
+    '''
+    return np.where(np.isnan(values), None, np.round(values, decimals)).tolist()
+
+def cohort_stats(db, user_ids, start: dt.date, end: dt.date, metrics=None, per_athlete=True):
+    '''
+    Per-day and per-athlete stats for a set of athletes over the days in [start, end).
+
+    Each athlete's daily average for a metric is placed in a (day x athlete) matrix, so the
+    per-day mean, count and percentile bands reduce across each row and the per-athlete means
+    reduce down each column. Lists in the result are aligned with "days" and "athletes" respectively.
+    With per_athlete=False the athlete list and per-athlete stats are left out, e.g. for stats shown to students.
+    '''
+    metrics = list(metrics or METRICS)
+    athletes = np.array(sorted(set(user_ids)), dtype=np.int64)
+    n_days = (end - start).days
+
+    select_columns = ", ".join(f"{metric}_sum, {metric}_count" for metric in metrics)
+    rows = db.execute_query_fetchall(
+        f"SELECT user_id, day, {select_columns} FROM log_daily_rollup WHERE user_id = ANY(%s) AND day >= %s AND day < %s",
+        (athletes.tolist(), start, end)
+    )
+
+    stats = {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "days": [(start + dt.timedelta(days=i)).isoformat() for i in range(n_days)],
+        "athletes": athletes.tolist(),
+        "metrics": {}
+    }
+
+    if rows:
+        columns = list(zip(*rows))
+        athlete_index = np.searchsorted(athletes, np.array(columns[0], dtype=np.int64))
+        day_index = (np.array(columns[1], dtype="datetime64[D]") - np.datetime64(start, "D")).astype(np.int64)
+    for i, metric in enumerate(metrics):
+        matrix = np.full((n_days, len(athletes)), np.nan)
+        if rows:
+            sums = np.array(columns[2 + i * 2], dtype=float)
+            counts = np.array(columns[3 + i * 2], dtype=float)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                matrix[day_index, athlete_index] = sums / counts
+
+        logged = ~np.isnan(matrix)
+        with warnings.catch_warnings():
+            # Days or athletes with no values reduce to NaN, which is what we want to report
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            bands = np.nanpercentile(matrix, list(PERCENTILES.values()), axis=1) if len(athletes) else np.full((len(PERCENTILES), n_days), np.nan)
+            metric_stats = {
+                "n": logged.sum(axis=1).tolist(),
+                "mean": to_list(np.nanmean(matrix, axis=1))
+            }
+            metric_stats.update({name: to_list(band) for name, band in zip(PERCENTILES, bands)})
+            if per_athlete:
+                metric_stats["athlete_mean"] = to_list(np.nanmean(matrix, axis=0))
+                metric_stats["athlete_days"] = logged.sum(axis=0).tolist()
+        stats["metrics"][metric] = metric_stats
+    if not per_athlete:
+        del stats["athletes"]
+    return stats
@@ -2,16 +2,80 @@
 #
 # Overview:
 # - All Admin endpoints
+# - Server metrics
 
-from flask import Blueprint, jsonify
-from __main__ import db, app, require_authentication, require_type
+import os
+from flask import Blueprint, jsonify, request
+from __main__ import db, app, ts, hasher, require_authentication, require_type, current_user, Responses
+from roster import parse_roster, hash_passwords
 bp = Blueprint('admin', __name__, url_prefix="/admin")
 
-@bp.get('/sync/users')
+@bp.post('/sync/users')
 @require_authentication
 @require_type('admin')
 def sync_users():
     '''
-    Sync users from external system.
+    Sync users from a school roster, as a background job.
+    The roster is a CSV or JSON file uploaded as "roster" (format from its extension or the "format" field),
+    or the request body itself (text/csv or application/json).
+    Options (query or form fields): deactivate_missing (default true), dry_run (default false).
+    Returns the job's task_id, to follow with GET /admin/sync/users/<task_id>.
     '''
-    pass
\ No newline at end of file
+    upload = request.files.get('roster')
+    if upload is not None:
+        data = upload.read()
+        roster_format = request.values.get('format', upload.filename.rsplit(".", 1)[-1].lower() if "." in (upload.filename or "") else None)
+    else:
+        data = request.get_data()
+        roster_format = request.values.get('format', 'json' if request.is_json else 'csv' if request.mimetype == 'text/csv' else None)
+    try: records = parse_roster(data, roster_format)
+    except (ValueError, UnicodeDecodeError) as e: return Responses.Bad_Request_400(details=str(e)).build()
+
+    # Catch unknown groups now rather than as per-user errors in the job
+    names = sorted({name for record in records for name in record['groups'] or []})
+    known = {row[0] for row in db.execute_query_fetchall("SELECT name FROM groups WHERE name = ANY(%s)", (names,))}
+    if unknown := [name for name in names if name not in known]:
+        return Responses.Bad_Request_400(details=f"Unknown groups: {', '.join(unknown)}").build()
+
+    deactivate_missing = request.values.get('deactivate_missing', 'true').lower() in ('true', '1', 'yes')
+    dry_run = request.values.get('dry_run', 'false').lower() in ('true', '1', 'yes')
+    # Hash new users' passwords here, so the queued job never carries them in plaintext
+    existing = {row[0] for row in db.execute_query_fetchall("SELECT username FROM users WHERE username = ANY(%s)", ([record['username'] for record in records],))}
+    records = hash_passwords(records, existing, int(os.getenv("ROSTER_SYNC_HASH_WORKERS", str(os.cpu_count() or 2))))
+    job = ts.sync_users.delay(records, deactivate_missing, [current_user(request)], dry_run)
+    return Responses.Accepted_202(data={"task_id": job.id, "users": len(records)}).build()
+
+@bp.get('/sync/users/<task_id>')
+@require_authentication
+@require_type('admin')
+def get_sync_status(task_id):
+    '''
+    Progress of a roster sync job: its state, how many changes are done out of the total, and the summary once finished.
+    '''
+    job = ts.sync_users.AsyncResult(task_id)
+    data = {"task_id": task_id, "state": job.state}
+    match job.state:
+        case 'PROGRESS':
+            data.update(job.info or {})
+        case 'SUCCESS':
+            data["result"] = job.result
+        case 'FAILURE':
+            data["error"] = str(job.result)
+    return Responses.OK_200(data=data).build()
+
+@bp.get('/metrics/db')
+@require_authentication
+@require_type('admin')
+def get_db_metrics():
+    '''
+    Retrieve database connection pool metrics.
+    '''
+    return Responses.OK_200(data={"pool": db.pool.metrics()}).build()
+@bp.get('/metrics/hashing')
+@require_authentication
+@require_type('admin')
+def get_hashing_metrics():
+    '''
+    Retrieve password hashing pool metrics.
+    '''
+    return Responses.OK_200(data={"hashing": hasher.metrics()}).build()
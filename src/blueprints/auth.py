@@ -5,11 +5,14 @@
 # - Token management
 # - User registration
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, g
 import jwt
-import hashlib, os, hmac
+import uuid
+from passwords import HasherBusy, HasherUnavailable
+from revocation import RevocationUnavailable
+from membership import set_user_groups
 from datetime import datetime, timedelta, timezone
-from __main__ import db, app, Responses
+from __main__ import db, app, hasher, identities, limiter, revocations, Responses
 import logging
 import psycopg2
 
@@ -17,26 +20,37 @@ logger = logging.getLogger(__name__)
 
 bp = Blueprint('auth', __name__, url_prefix="/auth")
 
-# Directly from https://stackoverflow.com/questions/9594125/salt-and-hash-a-password-in-python
-def hash_new_password(password: str) -> tuple[bytes, bytes]:
-    """
-    Hash the provided password with a randomly-generated salt and return the
-    salt and hash to store in the database.
-    """
-    salt = os.urandom(16)
-    pw_hash = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, 100000)
-    return salt, pw_hash
-
-def is_correct_password(salt: bytes, pw_hash: bytes, password: str) -> bool:
-    """
-    Given a previously-stored salt and hash, and a password provided by a user
-    trying to log in, check whether the password is correct.
-    """
-    return hmac.compare_digest(
-        pw_hash,
-        hashlib.pbkdf2_hmac('sha256', password.encode(), salt, 100000)
-    )
-
+# Rate limiting
+from functools import wraps
+import math
+def rate_limit(group, key='user', cost=None):
+    '''
+    Limit requests per subject with the limiter's token bucket for `group`.
+    key: 'user' (authenticated user id, so apply after require_authentication), 'ip', or 'username' (from the JSON body,
+    falling back to the client IP when the body has no username, so those requests are still limited but don't share one bucket).
+    cost: optional function returning how many tokens the request uses, e.g. the number of logs in a batch.
+    '''
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            match key:
+                case 'user':
+                    subject = g.get('user_id')
+                case 'ip':
+                    subject = request.remote_addr
+                case 'username':
+                    body = request.get_json(silent=True)
+                    username = body.get('username') if isinstance(body, dict) else None
+                    # Prefixed so a username can't share a bucket with an IP address
+                    subject = f"username:{username.lower()}" if isinstance(username, str) and username else f"ip:{request.remote_addr}"
+            if subject is not None:
+                allowed, retry_after = limiter.hit(group, subject, cost() if cost else 1)
+                if not allowed:
+                    logger.warning("Rate limit %s exceeded by %s", group, subject)
+                    return Responses.Too_Many_Requests_429(details="Rate limit exceeded, try again later", retry_after=math.ceil(retry_after)).build()
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
 
 # Base functions
 def authorize(username, password):
@@ -47,20 +61,82 @@ def authorize(username, password):
     logger.debug("Authorizing user: %s with password %s", username, password)
     try:
         user = db.execute_query_fetchall(
-            "SELECT id, password_salt, password_hash FROM users WHERE username = %s",
+            "SELECT id, password_salt, password_hash FROM users WHERE username = %s AND active",
             (username,)
         )[0]
         id, salt, pw_hash = user
-        if is_correct_password(bytes.fromhex(salt), bytes.fromhex(pw_hash), password):
-            token = jwt.encode({'user': id, "exp": (datetime.now(timezone.utc) + timedelta(days=30)).timestamp()}, app.config['SECRET_KEY'], algorithm='HS256')
-            return {"token": token}, 200
+        if hasher.verify(bytes.fromhex(salt), bytes.fromhex(pw_hash), password):
+            return issue_tokens(id), 200
         logger.warning("Incorrect password for user: %s", username)
     except IndexError:
         # user not in database
         logger.warning("User not found: %s", username)
+    except HasherBusy as e:
+        logger.warning("Authorization rejected for user %s: %s", username, e)
+        return {"details": "Server busy, try again shortly"}, 429
+    except HasherUnavailable as e:
+        logger.warning("Authorization failed for user %s: %s", username, e)
+        return {"details": "Server unavailable, try again shortly"}, 503
     return {"details": "Invalid username or password"}, 401
 
+def issue_tokens(user_id, sid=None):
+    '''
+    Issue a short-lived access token and a refresh token for a session (a new one unless sid is given).
+    '''
+    now = datetime.now(timezone.utc)
+    sid = sid or uuid.uuid4().hex
+    tokens = {}
+    for token_type, key, lifetime in (('access', 'token', app.config['ACCESS_TOKEN_LIFETIME']), ('refresh', 'refresh_token', app.config['REFRESH_TOKEN_LIFETIME'])):
+        tokens[key] = jwt.encode({
+            'user': user_id,
+            'typ': token_type,
+            'jti': uuid.uuid4().hex,
+            'sid': sid,
+            'iat': now.timestamp(),
+            'exp': (now + lifetime).timestamp()
+        }, app.config['SECRET_KEY'], algorithm='HS256')
+    tokens['expires_in'] = int(app.config['ACCESS_TOKEN_LIFETIME'].total_seconds())
+    return tokens
+
+def decode_token(token, token_type='access', check_revoked=True):
+    '''
+    Decode and validate a token of the given type. Returns (claims, None) or (None, error details).
+    '''
+    try:
+        decoded = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+        if decoded["exp"] < datetime.now(timezone.utc).timestamp():
+            raise jwt.ExpiredSignatureError
+    except jwt.ExpiredSignatureError:
+        return None, "Token has expired"
+    except jwt.InvalidTokenError:
+        return None, "Invalid token"
+    if decoded.get('typ') != token_type:
+        return None, "Invalid token"
+    if check_revoked and revocations.is_revoked(decoded):
+        return None, "Token has been revoked"
+    return decoded, None
+
+def refresh(refresh_token):
+    claims, details = decode_token(refresh_token, 'refresh', check_revoked=False)
+    if claims is None:
+        return {"details": details}, 401
+    try:
+        if identities.get(claims['user']) is None:
+            return {"details": "User not found"}, 401
+        # Refresh tokens are single use: the token is claimed (marked used) atomically, so of two requests
+        # racing with the same token only one gets new tokens. Seeing one again means it was copied: end the whole session
+        if revocations.is_revoked(claims) or not revocations.claim(f"jti:{claims['jti']}", claims['exp'] - datetime.now(timezone.utc).timestamp()):
+            logger.warning("Reused refresh token for user %s, revoking session %s", claims['user'], claims['sid'])
+            revocations.revoke(f"sid:{claims['sid']}", app.config['REFRESH_TOKEN_LIFETIME'].total_seconds())
+            return {"details": "Token has been revoked"}, 401
+    except RevocationUnavailable:
+        return {"details": "Token refresh is unavailable, try again shortly"}, 503
+    return issue_tokens(claims['user'], claims['sid']), 200
+
 def current_user(request):
+    # Already decoded by require_authentication for this request
+    if g.get('user_id') is not None:
+        return g.user_id
     token = request.headers.get('Authorization', '').replace('Bearer ', '')
     auth_response, status_code = authenticate(token)
     if status_code != 200:
@@ -68,24 +144,40 @@ def current_user(request):
     return auth_response['user']
 
 def authenticate(token):
-    try:
-        decoded = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        if decoded["exp"] < datetime.now(timezone.utc).timestamp():
-            raise jwt.ExpiredSignatureError
-        return {"user": decoded['user']}, 200
-    except jwt.ExpiredSignatureError:
-        return {"details": "Token has expired"}, 401
-    except jwt.InvalidTokenError:
-        return {"details": "Invalid token"}, 401
+    claims, details = decode_token(token)
+    if claims is None:
+        return {"details": details}, 401
+    return {"user": claims['user']}, 200
 
-def register(username, password, pname, fname, lname, email, type):
-    salt, pw_hash = hash_new_password(password)
+class GroupsChanged(Exception):
+    pass
+
+def register(username, password, pname, fname, lname, email, type, groups=()):
+    '''
+    Create a user, and add them to `groups` (group ids) in the same transaction.
+    '''
+    try: salt, pw_hash = hasher.hash(password)
+    except HasherBusy as e:
+        logger.warning("Registration rejected for user %s: %s", username, e)
+        return {"details": "Server busy, try again shortly"}, 429
+    except HasherUnavailable as e:
+        logger.warning("Registration failed for user %s: %s", username, e)
+        return {"details": "Server unavailable, try again shortly"}, 503
     try:
-        db.execute_query(
-            "INSERT INTO users (username, email, password_hash, password_salt, pname, fname, lname, type) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-            (username, email, pw_hash.hex(), salt.hex(), pname, fname, lname, type)
-        )
-        return {"message": "User registered successfully"}, 201
+        with db.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO users (username, email, password_hash, password_salt, pname, fname, lname, type) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id",
+                (username, email, pw_hash.hex(), salt.hex(), pname, fname, lname, type)
+            )
+            user_id = cursor.fetchone()[0]
+            if groups:
+                joined, _ = set_user_groups(cursor, user_id, groups)
+                # A group deleted since the caller checked it is skipped by set_user_groups; don't create the user without it
+                if len(joined) != len(set(groups)):
+                    raise GroupsChanged()
+        return {"message": "User registered successfully", "user_id": user_id}, 201
+    except GroupsChanged:
+        return {"details": "One or more groups are invalid"}, 400
     except psycopg2.IntegrityError as e:
         logger.warning("Registration failed for user %s: %s", username, e)
         return {"details": "Username or email already exists"}, 400
@@ -93,6 +185,8 @@ def register(username, password, pname, fname, lname, email, type):
         return {"details": str(e)}, 500
 
 @bp.post('/authorize')
+@rate_limit('login', key='ip')
+@rate_limit('login_user', key='username')
 def route_authorize():
     username = request.json.get('username')
     password = request.json.get('password')
@@ -103,8 +197,26 @@ def route_authorize():
             return Responses.OK_200(response).build()
         case 401:
             return Responses.Unauthorized_401(details=response.get("details")).build()
+        case 429:
+            return Responses.Too_Many_Requests_429(details=response.get("details"), retry_after=1).build()
+        case 503:
+            return Responses.Service_Unavailable_503(details=response.get("details"), retry_after=1).build()
         case _:
-            return Responses.Internal_Server_Error_500(details="An unknown error occurred during authorization.").build
+            return Responses.Internal_Server_Error_500(details="An unknown error occurred during authorization.").build()
+
+@bp.post('/refresh')
+def route_refresh():
+    response, status_code = refresh(request.json.get('refresh_token'))
+
+    match status_code:
+        case 200:
+            return Responses.OK_200(response).build()
+        case 401:
+            return Responses.Unauthorized_401(details=response.get("details")).build()
+        case 503:
+            return Responses.Service_Unavailable_503(details=response.get("details"), retry_after=5).build()
+        case _:
+            return Responses.Internal_Server_Error_500(details="An unknown error occurred during token refresh.").build()
 
 @bp.get('/authenticate')
 def route_authenticate():
@@ -120,6 +232,7 @@ def route_authenticate():
             return Responses.Internal_Server_Error_500(details="An unknown error occurred during authentication.").build()
     
 @bp.post('/register')
+@rate_limit('register', key='ip')
 def route_register():
     username = request.json.get('username')
     password = request.json.get('password')
@@ -135,52 +248,92 @@ def route_register():
             return Responses.Created_201(response).build()
         case 400:
             return Responses.Bad_Request_400(details=response.get("details")).build()
+        case 429:
+            return Responses.Too_Many_Requests_429(details=response.get("details"), retry_after=1).build()
+        case 503:
+            return Responses.Service_Unavailable_503(details=response.get("details"), retry_after=1).build()
         case _:
             return Responses.Internal_Server_Error_500(details="An unknown error occurred during registration.").build()
 
     
 # Decorators
-from functools import wraps
 def require_authentication(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         token = request.headers.get('Authorization', '').replace('Bearer ', '')
-        auth_response, status_code = authenticate(token)
-        if status_code != 200:
-            return Responses.Unauthorized_401(details=auth_response.get("details")).build()
-        request.user = auth_response['user']
+        claims, details = decode_token(token)
+        if claims is None:
+            return Responses.Unauthorized_401(details=details).build()
+        g.claims = claims
+        request.user = g.user_id = claims['user']
         return f(*args, **kwargs)
     return decorated_function
 
+def current_identity():
+    '''
+    The authenticated user's {"id", "type", "groups"}, loaded at most once per request
+    (and usually from the identity cache), or None if the user no longer exists.
+    '''
+    if 'identity' not in g:
+        g.identity = identities.get(g.user_id)
+    return g.identity
+
 def require_type(user_type):
     # 1. Admin
-    # 2. Staff
+    # 2. Staff (teacher)
     # 3. Student
 
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            token = request.headers.get('Authorization', '').replace('Bearer ', '')
-            auth_response, status_code = authenticate(token)
-            if status_code != 200:
-                return jsonify(auth_response), status_code
-            user_id = auth_response['user']
-            user = db.execute_query_fetchall(
-                "SELECT type FROM users WHERE id = %s",
-                (user_id,)
-            )[0]
+            if g.get('user_id') is None:
+                token = request.headers.get('Authorization', '').replace('Bearer ', '')
+                auth_response, status_code = authenticate(token)
+                if status_code != 200:
+                    return Responses.Unauthorized_401(details=auth_response.get("details")).build()
+                request.user = g.user_id = auth_response['user']
+            user = current_identity()
+            if user is None:
+                return Responses.Unauthorized_401(details="User not found").build()
             match user_type:
                 case 'admin':
-                    if user[0] != 'admin':
+                    if user['type'] != 'admin':
                         return Responses.Forbidden_403(details="Insufficient permissions").build()
-                case 'staff':
-                    if user[0] not in ('admin', 'staff'):
+                case 'staff' | 'teacher':
+                    if user['type'] not in ('admin', 'teacher'):
                         return Responses.Forbidden_403(details="Insufficient permissions").build()
                 case 'student':
-                    if user[0] != 'student':
+                    if user['type'] != 'student':
                         return Responses.Forbidden_403(details="Insufficient permissions").build()
-            request.user = user_id
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
+@bp.post('/logout')
+@require_authentication
+def route_logout():
+    '''
+    Revoke the current session, or every session of the user with {"all": true}.
+    '''
+    body = request.get_json(silent=True)
+    lifetime = app.config['REFRESH_TOKEN_LIFETIME'].total_seconds()
+    try:
+        if isinstance(body, dict) and body.get('all') is True:
+            revocations.revoke(f"user:{g.user_id}", lifetime)
+        else:
+            revocations.revoke(f"sid:{g.claims['sid']}", lifetime)
+    except RevocationUnavailable:
+        return Responses.Service_Unavailable_503(details="Could not sign out, try again shortly", retry_after=5).build()
+    return Responses.OK_200().build()
+
+@bp.post('/revoke/<int:user_id>')
+@require_authentication
+@require_type('admin')
+def route_revoke_user(user_id):
+    '''
+    Revoke every session of a user, e.g. after a device is lost.
+    '''
+    try: revocations.revoke(f"user:{user_id}", app.config['REFRESH_TOKEN_LIFETIME'].total_seconds())
+    except RevocationUnavailable:
+        return Responses.Service_Unavailable_503(details="Could not revoke sessions, try again shortly", retry_after=5).build()
+    return Responses.OK_200().build()
@@ -6,7 +6,10 @@
 # - Group management
 
 from flask import Blueprint, jsonify, request
-from __main__ import db, app, require_authentication, require_type, current_user, Responses, register
+import psycopg2
+from __main__ import db, app, identities, require_authentication, require_type, current_user, Responses, register
+from responses import version_etag
+from membership import USER_GROUPS, GROUP_STAFF, GROUP_STUDENTS, add_members, remove_members, set_user_groups, sync_roles, touch
 
 
 bp = Blueprint('iden', __name__, url_prefix="/iden")
@@ -32,7 +35,7 @@ def get_all_users():
     except AssertionError: return Responses.Bad_Request_400(details="Invalid sort_order").build()
 
 
-    users = db.execute_query_fetchall("SELECT id, username, pname, fname, lname, email, groups, type, ftue_complete, created_at, last_login FROM users ORDER BY {} {} LIMIT %s".format(sort_by, sort_order), (limit,))
+    users = db.execute_query_fetchall(f"SELECT id, username, pname, fname, lname, email, {USER_GROUPS}, type, ftue_complete, created_at, last_login FROM users ORDER BY {sort_by} {sort_order} LIMIT %s", (limit,))
     return Responses.OK_200(data={"users": users}).build()
 
 @bp.get('/user/<int:user_id>')
@@ -42,9 +45,11 @@ def get_user_details(user_id):
     '''
     Retrieve user details by user ID.
     '''
-    try: user = db.execute_query_fetchall("SELECT id, username, pname, fname, lname, email, groups, type, ftue_complete, created_at, last_login FROM users WHERE id = %s", (user_id,))[0]
+    try: user = db.execute_query_fetchall(f"SELECT id, username, pname, fname, lname, email, {USER_GROUPS}, type, ftue_complete, created_at, last_login, updated FROM users WHERE id = %s", (user_id,))[0]
     except IndexError: return Responses.Not_Found_404(details="User not found").build()
-    return Responses.OK_200(data={"user": user}).build()
+    etag = version_etag("user", user_id, user[-1])
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
+    return Responses.OK_200(data={"user": user[:-1]}).with_etag(etag).build()
 
 @bp.patch('/user/<int:user_id>')
 @require_authentication
@@ -53,20 +58,29 @@ def update_user_details(user_id):
     '''
     Update user details by user ID.
     '''
-    try: user = db.execute_query_fetchall("SELECT id FROM users WHERE id = %s", (user_id,))[0]
+    try: user = db.execute_query_fetchall("SELECT username, pname, fname, lname, email, type, ftue_complete FROM users WHERE id = %s", (user_id,))[0]
     except IndexError: return Responses.Not_Found_404(details="User not found").build()
-    
-    db.execute_query("UPDATE users SET username = %s, pname = %s, fname = %s, lname = %s, email = %s, groups = %s, type = %s, ftue_complete = %s WHERE id = %s", (
-        request.json.get('username', user[0]),
-        request.json.get('pname', user[1]),
-        request.json.get('fname', user[2]),
-        request.json.get('lname', user[3]),
-        request.json.get('email', user[4]),
-        request.json.get('groups', user[5]),
-        request.json.get('type', user[6]),
-        request.json.get('ftue_complete', user[7]),
-        user_id
-    ))
+
+    groups = request.json.get('groups', None)
+    try: assert groups is None or (isinstance(groups, list) and all(isinstance(g, int) for g in groups))
+    except AssertionError: return Responses.Bad_Request_400(details="Invalid groups").build()
+
+    with db.transaction() as cursor:
+        cursor.execute("UPDATE users SET username = %s, pname = %s, fname = %s, lname = %s, email = %s, type = %s, ftue_complete = %s, updated = NOW() WHERE id = %s", (
+            request.json.get('username', user[0]),
+            request.json.get('pname', user[1]),
+            request.json.get('fname', user[2]),
+            request.json.get('lname', user[3]),
+            request.json.get('email', user[4]),
+            request.json.get('type', user[5]),
+            request.json.get('ftue_complete', user[6]),
+            user_id
+        ))
+        if request.json.get('type', user[5]) != user[5]:
+            sync_roles(cursor, [user_id])
+        if groups is not None:
+            set_user_groups(cursor, user_id, groups)
+    identities.invalidate(user_id)
 
     return Responses.OK_200().build()
 
@@ -79,7 +93,11 @@ def delete_user(user_id):
     '''
     try: db.execute_query_fetchall("SELECT id FROM users WHERE id = %s", (user_id,))[0]
     except IndexError: return Responses.Not_Found_404(details="User not found").build()
-    db.execute_query("DELETE FROM users WHERE id = %s", (user_id,))
+    with db.transaction() as cursor:
+        cursor.execute("DELETE FROM group_members WHERE user_id = %s RETURNING group_id", (user_id,))
+        touch(cursor, [row[0] for row in cursor.fetchall()], [])
+        cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+    identities.invalidate(user_id)
     return Responses.OK_200().build()
 
 @bp.post('/user')
@@ -115,7 +133,7 @@ def create_user():
         except AssertionError: return Responses.Bad_Request_400(details="Invalid email address").build()
 
         groups = request.json.get('groups', [])
-        try: assert isinstance(groups, list) and all(isinstance(g, int) for g in groups) and all(len(db.execute_query_fetchall("SELECT id FROM groups WHERE id = %s", (g,))) > 0 for g in groups)
+        try: assert isinstance(groups, list) and all(isinstance(g, int) for g in groups) and db.execute_query_fetchone("SELECT COUNT(*) FROM groups WHERE id = ANY(%s)", (groups,))[0] == len(set(groups))
         except AssertionError: return Responses.Bad_Request_400(details="One or more groups are invalid").build()
 
         type = request.json.get('type', 'student')
@@ -124,15 +142,16 @@ def create_user():
     except KeyError as e:
         return Responses.Bad_Request_400(details=f"Missing required field: {e.args[0]}").build()
     
-    resp = register(username, password, pname, fname, lname, email, type)
+    resp = register(username, password, pname, fname, lname, email, type, groups)
     match resp[1]:
         case 201:
-            user_id = db.execute_query_fetchall("SELECT id FROM users WHERE username = %s", (username,))[0][0]
-            for group_id in groups:
-                join_group(user_id, group_id)
-            return Responses.Created_201(data={"user_id": user_id}).build()
+            return Responses.Created_201(data={"user_id": resp[0]["user_id"]}).build()
         case 400:
             return Responses.Bad_Request_400(details=resp[0].get("details")).build()
+        case 429:
+            return Responses.Too_Many_Requests_429(details=resp[0].get("details"), retry_after=1).build()
+        case 503:
+            return Responses.Service_Unavailable_503(details=resp[0].get("details"), retry_after=1).build()
         case _:
             return Responses.Internal_Server_Error_500(details="An unknown error occurred during user creation.").build()
         
@@ -144,8 +163,12 @@ def get_own_details():
     Retrieve details of the authenticated user.
     '''
     user = current_user(request)
-    details = db.execute_query_fetchone("SELECT id, username, pname, fname, lname, email, groups, type, ftue_complete, created_at, last_login FROM users WHERE id = %s", (user,))
-    return Responses.OK_200(data={"user": details}).build()
+    details = db.execute_query_fetchone(f"SELECT id, username, pname, fname, lname, email, {USER_GROUPS}, type, ftue_complete, created_at, last_login, updated FROM users WHERE id = %s AND active", (user,))
+    if details is None:
+        return Responses.Not_Found_404(details="User not found").build()
+    etag = version_etag("user", user, details[-1])
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
+    return Responses.OK_200(data={"user": details[:-1]}).with_etag(etag).build()
 
 @bp.patch('/user/me')
 @require_authentication
@@ -154,8 +177,10 @@ def update_own_details():
     Update details of the authenticated user.
     '''
     user = current_user(request)
-    current_details = db.execute_query_fetchone("SELECT username, pname, fname, lname, email, type, ftue_complete FROM users WHERE id = %s", (user,))
-    db.execute_query("UPDATE users SET username = %s, pname = %s, fname = %s, lname = %s, email = %s, type = %s, ftue_complete = %s WHERE id = %s", (
+    current_details = db.execute_query_fetchone("SELECT username, pname, fname, lname, email, type, ftue_complete FROM users WHERE id = %s AND active", (user,))
+    if current_details is None:
+        return Responses.Not_Found_404(details="User not found").build()
+    db.execute_query("UPDATE users SET username = %s, pname = %s, fname = %s, lname = %s, email = %s, type = %s, ftue_complete = %s, updated = NOW() WHERE id = %s", (
         request.json.get('username', current_details[0]),
         request.json.get('pname', current_details[1]),
         request.json.get('fname', current_details[2]),
@@ -165,43 +190,30 @@ def update_own_details():
         request.json.get('ftue_complete', current_details[6]),
         user
     ))
+    identities.invalidate(user)
     return Responses.OK_200().build()
 
 # Groups
 def join_group(user_id, group_id):
     '''
-    Add a user to a group.
+    Add a user to a group, as a student or staff member depending on their user type.
     '''
-    user = db.execute_query_fetchone("SELECT id, groups, type FROM users WHERE id = %s", (user_id,))
-    if group_id in user[1]:
+    with db.transaction() as cursor:
+        added = add_members(cursor, group_id, [user_id])
+    if not added:
         return "User already in group", 400
-    match user[2]:
-        case 'student':
-            db.execute_query("UPDATE users SET groups = array_append(groups, %s) WHERE id = %s", (group_id, user_id))
-            db.execute_query("UPDATE groups SET students = array_append(students, %s) WHERE id = %s", (user_id, group_id))
-        case 'teacher' | 'admin':
-            db.execute_query("UPDATE users SET groups = array_append(groups, %s) WHERE id = %s", (group_id, user_id))
-            db.execute_query("UPDATE groups SET staff = array_append(staff, %s) WHERE id = %s", (user_id, group_id))
-        case _:
-            return "Invalid user type", 500
+    identities.invalidate(user_id)
     return "User added to group", 200
     
 def leave_group(user_id, group_id):
     '''
     Remove a user from a group.
     '''
-    user = db.execute_query_fetchone("SELECT id, groups, type FROM users WHERE id = %s", (user_id,))
-    if group_id not in user[1]:
+    with db.transaction() as cursor:
+        removed = remove_members(cursor, group_id, [user_id])
+    if not removed:
         return "User not in group", 400
-    match user[2]:
-        case 'student':
-            db.execute_query("UPDATE users SET groups = array_remove(groups, %s) WHERE id = %s", (group_id, user_id))
-            db.execute_query("UPDATE groups SET students = array_remove(students, %s) WHERE id = %s", (user_id, group_id))
-        case 'teacher' | 'admin':
-            db.execute_query("UPDATE users SET groups = array_remove(groups, %s) WHERE id = %s", (group_id, user_id))
-            db.execute_query("UPDATE groups SET staff = array_remove(staff, %s) WHERE id = %s", (user_id, group_id))
-        case _:
-            return "Invalid user type", 500
+    identities.invalidate(user_id)
     return "User removed from group", 200
 
 @bp.get('/groups')
@@ -211,8 +223,11 @@ def get_all_groups():
     '''
     Retrieve a list of all groups.
     '''
-    groups = db.execute_query_fetchall("SELECT id, name, description, created_at, staff, students FROM groups")
-    return Responses.OK_200(data={"groups": groups}).build()
+    version = db.execute_query_fetchone("SELECT MAX(updated), COUNT(*), MAX(id) FROM groups")
+    etag = version_etag("groups", *version)
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
+    groups = db.execute_query_fetchall(f"SELECT id, name, description, created_at, {GROUP_STAFF}, {GROUP_STUDENTS} FROM groups")
+    return Responses.OK_200(data={"groups": groups}).with_etag(etag).build()
 
 @bp.put('/group')
 @require_authentication
@@ -239,25 +254,35 @@ def create_group():
         except AssertionError: return Responses.Bad_Request_400(details="Invalid group type").build()
         
         staff = request.json.get('staff', [current_user(request)])
-        try: assert isinstance(staff, list) and all(isinstance(s, int) for s in staff) and all(len(db.execute_query_fetchall("SELECT id FROM users WHERE id = %s AND type IN ('teacher', 'admin')", (s,))) > 0 for s in staff)
+        try: assert isinstance(staff, list) and all(isinstance(s, int) for s in staff)
         except AssertionError: return Responses.Bad_Request_400(details="One or more staff members are invalid").build()
 
         students = request.json.get('students', [])
-        try: assert isinstance(students, list) and all(isinstance(s, int) for s in students) and all(len(db.execute_query_fetchall("SELECT id FROM users WHERE id = %s AND type = 'student'", (s,))) > 0 for s in students)
+        try: assert isinstance(students, list) and all(isinstance(s, int) for s in students)
         except AssertionError: return Responses.Bad_Request_400(details="One or more students are invalid").build()
 
-        db.execute_query("INSERT INTO groups (name, description, short, type) VALUES (%s, %s, %s, %s)", (
-            name,
-            description,
-            short,
-            type,
-        ))
-        for staff_id in staff:
-            join_group(staff_id, db.execute_query_fetchall("SELECT id FROM groups WHERE name = %s AND short = %s", (name, short))[0][0])
-        for student_id in students:
-            join_group(student_id, db.execute_query_fetchall("SELECT id FROM groups WHERE name = %s AND short = %s", (name, short))[0][0])
-        
-        return Responses.Created_201().build()
+        # Both member lists are checked in one query, however large the group
+        valid_staff, valid_students = db.execute_query_fetchone(
+            "SELECT COUNT(*) FILTER (WHERE id = ANY(%s) AND type IN ('teacher', 'admin')), COUNT(*) FILTER (WHERE id = ANY(%s) AND type = 'student') FROM users WHERE id = ANY(%s)",
+            (staff, students, staff + students)
+        )
+        if valid_staff != len(set(staff)): return Responses.Bad_Request_400(details="One or more staff members are invalid").build()
+        if valid_students != len(set(students)): return Responses.Bad_Request_400(details="One or more students are invalid").build()
+
+        try:
+            with db.transaction() as cursor:
+                cursor.execute("INSERT INTO groups (name, description, short, type) VALUES (%s, %s, %s, %s) RETURNING id", (
+                    name,
+                    description,
+                    short,
+                    type,
+                ))
+                group_id = cursor.fetchone()[0]
+                members = add_members(cursor, group_id, staff + students)
+        except psycopg2.IntegrityError: return Responses.Bad_Request_400(details="A group with this name already exists").build()
+        identities.invalidate(*members)
+
+        return Responses.Created_201(data={"group_id": group_id}).build()
     except KeyError as e:
         return Responses.Bad_Request_400(details=f"Missing required field: {e.args[0]}").build()
 
@@ -267,9 +292,64 @@ def get_group_details(group_id):
     '''
     Retrieve group details by group ID.
     '''
-    try: group = db.execute_query_fetchall("SELECT id, name, description, short, type, created_at FROM groups WHERE id = %s", (group_id,))[0]
+    try: group = db.execute_query_fetchall("SELECT id, name, description, short, type, created_at, updated FROM groups WHERE id = %s", (group_id,))[0]
     except IndexError: return Responses.Not_Found_404(details="Group not found").build()
-    return Responses.OK_200(data={"group": group}).build()
+    etag = version_etag("group", group_id, group[-1])
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
+    return Responses.OK_200(data={"group": group[:-1]}).with_etag(etag).build()
+
+# Version of everything a group roster shows: the group and its membership, its members' profiles,
+# streaks and latest logs. None if the group doesn't exist. Each member's latest log is read from the end of
+# the (user_id, timestamp, id) index in each partition, so the check doesn't grow with the members' history.
+ROSTER_VERSION = '''
+    SELECT g.updated,
+        (SELECT MAX(u.updated) FROM group_members m JOIN users u ON u.id = m.user_id WHERE m.group_id = g.id),
+        (SELECT MAX(s.updated) FROM group_members m JOIN streaks s ON s.user_id = m.user_id WHERE m.group_id = g.id),
+        latest_logs.ids
+    FROM groups g
+    CROSS JOIN LATERAL (
+        SELECT md5(string_agg(m.user_id || ':' || COALESCE(latest.id::text, ''), ',' ORDER BY m.user_id)) AS ids
+        FROM group_members m
+        LEFT JOIN LATERAL (
+            SELECT id FROM log WHERE user_id = m.user_id ORDER BY timestamp DESC, id DESC LIMIT 1
+        ) latest ON TRUE
+        WHERE m.group_id = g.id
+    ) latest_logs
+    WHERE g.id = %s
+'''
+ROSTER_COLUMNS = ['id', 'username', 'pname', 'fname', 'lname', 'email', 'type', 'role', 'joined_at', 'active', 'last_login', 'streak']
+
+@bp.get('/group/<int:group_id>/roster')
+@require_authentication
+@require_type('teacher')
+def get_group_roster(group_id):
+    '''
+    Retrieve a group's members with their profile, role, current streak and latest log, staff first.
+    '''
+    version = db.execute_query_fetchone(ROSTER_VERSION, (group_id,))
+    if version is None: return Responses.Not_Found_404(details="Group not found").build()
+    etag = version_etag("roster", group_id, *version)
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
+
+    # Each member's latest log comes from the (user_id, timestamp, id) index, one short scan per member
+    rows = db.execute_query_fetchall('''
+        SELECT u.id, u.username, u.pname, u.fname, u.lname, u.email, u.type, m.role, m.joined_at, u.active, u.last_login,
+            COALESCE(s.current_length, 0), latest.id, latest.type, latest.timestamp
+        FROM group_members m
+        JOIN users u ON u.id = m.user_id
+        LEFT JOIN streaks s ON s.user_id = u.id
+        LEFT JOIN LATERAL (
+            SELECT id, type, timestamp FROM log WHERE user_id = u.id ORDER BY timestamp DESC, id DESC LIMIT 1
+        ) latest ON TRUE
+        WHERE m.group_id = %s
+        ORDER BY m.role = 'student', u.lname, u.fname, u.id
+    ''', (group_id,))
+    members = []
+    for row in rows:
+        member = dict(zip(ROSTER_COLUMNS, row))
+        member["latest_log"] = {"id": row[12], "type": row[13], "timestamp": row[14]} if row[12] is not None else None
+        members.append(member)
+    return Responses.OK_200(data={"group_id": group_id, "members": members}).with_etag(etag).build()
 
 @bp.patch('/group/<int:group_id>')
 @require_authentication
@@ -280,7 +360,7 @@ def update_group(group_id):
     '''
     try: group = db.execute_query_fetchall("SELECT id, name, description, short, type FROM groups WHERE id = %s", (group_id,))[0]
     except IndexError: return Responses.Not_Found_404(details="Group not found").build()
-    db.execute_query("UPDATE groups SET name = %s, description = %s, short = %s, type = %s WHERE id = %s", (
+    db.execute_query("UPDATE groups SET name = %s, description = %s, short = %s, type = %s, updated = NOW() WHERE id = %s", (
         request.json.get('name', group[1]),
         request.json.get('description', group[2]),
         request.json.get('short', group[3]),
@@ -298,6 +378,11 @@ def delete_group(group_id):
     '''
     try: db.execute_query_fetchall("SELECT id FROM groups WHERE id = %s", (group_id,))[0]
     except IndexError: return Responses.Not_Found_404(details="Group not found").build()
-    db.execute_query("DELETE FROM groups WHERE id = %s", (group_id,))
+    with db.transaction() as cursor:
+        cursor.execute("DELETE FROM group_members WHERE group_id = %s RETURNING user_id", (group_id,))
+        members = [row[0] for row in cursor.fetchall()]
+        touch(cursor, [], members)
+        cursor.execute("DELETE FROM groups WHERE id = %s", (group_id,))
+    identities.invalidate(*members)
     return Responses.OK_200().build()
 
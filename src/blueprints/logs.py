@@ -2,171 +2,170 @@
 #
 # Overview:
 # - Read, write, update and delete logs
+# - Batch log uploads
 # - Filter logs by user, date, type, etc.
 
-from flask import Blueprint, jsonify, request
-from __main__ import db, app, require_authentication, require_type, current_user, Responses
+from flask import Blueprint, jsonify, request, g
+import datetime as dt
+import os, threading, logging
+from psycopg2.extras import execute_values
+from rollups import refresh_daily_rollups
+from streaks import STREAK_LOG_TYPE, record_daily_log
+from __main__ import db, app, ts, require_authentication, require_type, rate_limit, current_user, current_identity, Responses
+from responses import version_etag
+from log_query import LogQuery, encode_cursor, decode_cursor
+
+logger = logging.getLogger(__name__)
 
 bp = Blueprint('logs', __name__, url_prefix="/logs")
 
+# Fields for each log type, and the python type their values must have
+LOG_TYPES = {
+    'daily': {'daily_muscle_soreness': int, 'daily_mood': str, 'daily_stress_level': int, 'notes': str},
+    'injury': {'injury_title': str, 'injury_state': int, 'injury_severity': str, 'notes': str},
+    'activity': {'activity_duration_minutes': int, 'activity_RPE': int, 'activity_related_id': int, 'notes': str},
+    'study': {'study_duration_minutes': int, 'notes': str},
+    'sleep': {'sleep_quality': int, 'sleep_duration_minutes': int, 'notes': str}
+}
+# Fields that may be omitted, and the value stored when they are
+OPTIONAL_FIELDS = {'notes': '', 'activity_related_id': None}
+LOG_COLUMNS = list(dict.fromkeys(field for fields in LOG_TYPES.values() for field in fields))
+FIELD_TYPES = {field: field_type for fields in LOG_TYPES.values() for field, field_type in fields.items()}
+
+# Statements built from the registry above, so a new log type only needs an entry there (and its columns)
+# get_log reads the whole row at once and keeps the columns of its type
+SELECT_LOG = f"SELECT type, user_id, timestamp, updated, {', '.join(LOG_COLUMNS)} FROM log WHERE {{key}}"
+INSERT_LOG = {
+    log_type: f"INSERT INTO log (user_id, type, timestamp, updated, {', '.join(fields)}) VALUES (%s, %s, NOW(), NOW(), {', '.join(['%s'] * len(fields))}) RETURNING timestamp"
+    for log_type, fields in LOG_TYPES.items()
+}
+# patch_log updates the fields given (a field given as null is cleared) in one statement.
+# Only the owner's log is matched, and only if it is of a type that has every field being changed.
+PATCH_LOG = "UPDATE log SET {assignments}, updated = NOW() WHERE {key} AND user_id = %s AND type = ANY(%s) RETURNING timestamp"
+
+BATCH_LIMIT = 500
+
+# The org stats snapshot is refreshed in the background after this many log writes
+ORG_STATS_REFRESH_WRITES = int(os.getenv("ORG_STATS_REFRESH_WRITES", "100"))
+writes_since_refresh = 0
+writes_lock = threading.Lock()
+
+@bp.after_request
+def count_log_writes(response):
+    '''
+    Count successful log writes, and queue an org stats refresh once enough have built up.
+    '''
+    global writes_since_refresh
+    if request.method not in ('PUT', 'PATCH', 'DELETE') or response.status_code >= 300:
+        return response
+    with writes_lock:
+        writes_since_refresh += g.get('logs_written', 1)
+        if writes_since_refresh < ORG_STATS_REFRESH_WRITES:
+            return response
+        writes_since_refresh = 0
+    try: ts.refresh_org_stats.delay()
+    except Exception as e: logger.warning("Could not queue org stats refresh: %s", e)
+    return response
+
+def log_key(log_id):
+    '''
+    The condition and parameters matching a log by its ID. The log is partitioned by timestamp, so an id alone is
+    looked up in every partition; callers that know the log's timestamp (listings return it) can pass it as
+    ?timestamp= to look in its partition only. Raises ValueError if the timestamp is invalid.
+    '''
+    timestamp = request.args.get('timestamp')
+    if timestamp is None:
+        return "id = %s", (log_id,)
+    return "id = %s AND timestamp = %s", (log_id, parse_timestamp(timestamp))
+
 @bp.get('/<int:log_id>')
 @require_authentication
 def get_log(log_id):
     '''
-    Retrieve a log by its ID.
+    Retrieve a log by its ID (and optionally its timestamp, see log_key).
     '''
-    try: metadata = db.execute_query_fetchall("SELECT type, user_id FROM log WHERE id = %s", (log_id,))[0]
-    except IndexError: return Responses.Not_Found_404(details="Log not found").build()
-    user = current_user(request)
-    if user != metadata[1]:
+    try: key, params = log_key(log_id)
+    except ValueError: return Responses.Bad_Request_400(details="Invalid timestamp parameter, must be an ISO datetime").build()
+    log = db.execute_query_fetchone(SELECT_LOG.format(key=key), params)
+    if log is None:
+        return Responses.Not_Found_404(details="Log not found").build()
+    log_type, owner, timestamp, updated = log[:4]
+    if current_user(request) != owner:
         return Responses.Forbidden_403(details="You do not have permission to view this log").build()
-    match metadata[0]:
-        case 'daily':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, daily_muscle_soreness, daily_mood, daily_stress_level, notes FROM log WHERE id = %s", (log_id,))
-            return Responses.OK_200(data={
-                "id": log_id,
-                "user_id": log[0],
-                "timestamp": log[1],
-                "updated": log[2],
-                "daily_muscle_soreness": log[3],
-                "daily_mood": log[4],
-                "daily_stress_level": log[5],
-                "notes": log[6]
-            }).build()
-        
-        case 'injury':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, injury_title, injury_state, injury_severity, notes FROM log WHERE id = %s", (log_id,))
-            return Responses.OK_200(data={
-                "id": log_id,
-                "user_id": log[0],
-                "timestamp": log[1],
-                "updated": log[2],
-                "injury_title": log[3],
-                "injury_state": log[4],
-                "injury_severity": log[5],
-                "notes": log[6]
-            }).build()
-        
-        case 'activity':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, activity_duration_minutes, activity_RPE, activity_related_id, notes FROM log WHERE id = %s", (log_id,))
-            return Responses.OK_200(data={
-                "id": log_id,
-                "user_id": log[0],
-                "timestamp": log[1],
-                "updated": log[2],
-                "activity_duration_minutes": log[3],
-                "activity_RPE": log[4],
-                "activity_related_id": log[5],
-                "notes": log[6]
-            }).build()
-
-        case 'study':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, study_duration_minutes, notes FROM log WHERE id = %s", (log_id,))
-            return Responses.OK_200(data={
-                "id": log_id,
-                "user_id": log[0],
-                "timestamp": log[1],
-                "updated": log[2],
-                "study_duration_minutes": log[3],
-                "notes": log[4]
-            }).build()
-        
-        case 'sleep':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, sleep_quality, sleep_duration_minutes, notes FROM log WHERE id = %s", (log_id,))
-            return Responses.OK_200(data={
-                "id": log_id,
-                "user_id": log[0],
-                "timestamp": log[1],
-                "updated": log[2],
-                "sleep_quality": log[3],
-                "sleep_duration_minutes": log[4],
-                "notes": log[5]
-            }).build()
-
-        case _:
-            return Responses.Internal_Server_Error_500(details="Unknown log type").build()
+    etag = version_etag("log", log_id, updated)
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
+    if log_type not in LOG_TYPES:
+        return Responses.Internal_Server_Error_500(details="Unknown log type").build()
+
+    columns = dict(zip(LOG_COLUMNS, log[4:]))
+    data = {"id": log_id, "user_id": owner, "timestamp": timestamp, "updated": updated}
+    data.update({field: columns[field] for field in LOG_TYPES[log_type]})
+    return Responses.OK_200(data=data).with_etag(etag).build()
 
 @bp.delete('/<int:log_id>')
 @require_authentication
+@rate_limit('log_writes')
 def delete_log(log_id):
     '''
-    Delete a log by its ID.
+    Delete a log by its ID (and optionally its timestamp, see log_key).
     '''
     user = current_user(request)
-    try: log_owner = db.execute_query_fetchall("SELECT user_id FROM log WHERE id = %s", (log_id,))[0][0]
+    try: key, params = log_key(log_id)
+    except ValueError: return Responses.Bad_Request_400(details="Invalid timestamp parameter, must be an ISO datetime").build()
+    try: log_owner = db.execute_query_fetchall(f"SELECT user_id FROM log WHERE {key}", params)[0][0]
     except IndexError: return Responses.Not_Found_404(details="Log not found").build()
     if user != log_owner:
         return Responses.Forbidden_403(details="You do not have permission to delete this log").build()
     else:
-        db.execute_query("DELETE FROM log WHERE id = %s", (log_id,))
+        with db.transaction() as cursor:
+            cursor.execute(f"DELETE FROM log WHERE {key} AND user_id = %s RETURNING timestamp", params + (user,))
+            deleted = cursor.fetchone()
+            # Deleted by another request since it was looked up
+            if deleted is None:
+                return Responses.Not_Found_404(details="Log not found").build()
+            refresh_daily_rollups(cursor, user, [deleted[0].date()])
         return Responses.OK_200(data={"message": "Log deleted successfully"}).build()
 
 @bp.patch('/<int:log_id>')
 @require_authentication
+@rate_limit('log_writes')
 def patch_log(log_id):
     '''
-    Update a log by its ID.
+    Update a log by its ID (and optionally its timestamp, see log_key). Only the fields given are changed.
     '''
-    try: metadata = db.execute_query_fetchall("SELECT type FROM log WHERE id = %s", (log_id,))[0]
-    except IndexError: return Responses.Not_Found_404(details="Log not found").build()
-    match metadata[0]:
-        case 'daily':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, daily_muscle_soreness, daily_mood, daily_stress_level, notes FROM log WHERE id = %s", (log_id,))
-            db.execute_query("UPDATE log SET daily_muscle_soreness = %s, daily_mood = %s, daily_stress_level = %s, notes = %s, updated = NOW() WHERE id = %s", (
-                request.json.get('daily_muscle_soreness', log[3]),
-                request.json.get('daily_mood', log[4]),
-                request.json.get('daily_stress_level', log[5]),
-                request.json.get('notes', log[6]),
-                log_id
-            ))
-            return Responses.OK_200(data={"message": "Log updated successfully"}).build()
-        
-        case 'injury':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, injury_title, injury_state, injury_severity, notes FROM log WHERE id = %s", (log_id,))
-            db.execute_query("UPDATE log SET injury_title = %s, injury_state = %s, injury_severity = %s, notes = %s, updated = NOW() WHERE id = %s", (
-                request.json.get('injury_title', log[3]),
-                request.json.get('injury_state', log[4]),
-                request.json.get('injury_severity', log[5]),
-                request.json.get('notes', log[6]),
-                log_id
-            ))
-            return Responses.OK_200(data={"message": "Log updated successfully"}).build()
-        
-        case 'activity':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, activity_duration_minutes, activity_RPE, activity_related_id, notes FROM log WHERE id = %s", (log_id,))
-            db.execute_query("UPDATE log SET activity_duration_minutes = %s, activity_RPE = %s, activity_related_id = %s, notes = %s, updated = NOW() WHERE id = %s", (
-                request.json.get('activity_duration_minutes', log[3]),
-                request.json.get('activity_RPE', log[4]),
-                request.json.get('activity_related_id', log[5]),
-                request.json.get('notes', log[6]),
-                log_id
-            ))
-            return Responses.OK_200(data={"message": "Log updated successfully"}).build()
-        
-        case 'study':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, study_duration_minutes, notes FROM log WHERE id = %s", (log_id,))
-            db.execute_query("UPDATE log SET study_duration_minutes = %s, notes = %s, updated = NOW() WHERE id = %s", (
-                request.json.get('study_duration_minutes', log[3]),
-                request.json.get('notes', log[4]),
-                log_id
-            ))
-            return Responses.OK_200(data={"message": "Log updated successfully"}).build()
-
-        case 'sleep':
-            log = db.execute_query_fetchone("SELECT user_id, timestamp, updated, sleep_quality, sleep_duration_minutes, notes FROM log WHERE id = %s", (log_id,))
-            db.execute_query("UPDATE log SET sleep_quality = %s, sleep_duration_minutes = %s, notes = %s, updated = NOW() WHERE id = %s", (
-                request.json.get('sleep_quality', log[3]),
-                request.json.get('sleep_duration_minutes', log[4]),
-                request.json.get('notes', log[5]),
-                log_id
-            ))
-            return Responses.OK_200(data={"message": "Log updated successfully"}).build()
-        
-        case _:
-            return Responses.Internal_Server_Error_500(details="Unknown log type").build()
+    user = current_user(request)
+    try: key, params = log_key(log_id)
+    except ValueError: return Responses.Bad_Request_400(details="Invalid timestamp parameter, must be an ISO datetime").build()
+    try: values = validate_fields(request.json, FIELD_TYPES, partial=True)
+    except ValueError as e: return Responses.Bad_Request_400(details=str(e)).build()
+    if not values:
+        return Responses.Bad_Request_400(details="No fields to update").build()
+    types = [log_type for log_type, fields in LOG_TYPES.items() if values.keys() <= fields.keys()]
+    if not types:
+        return Responses.Bad_Request_400(details="No log type has all of these fields").build()
+
+    with db.transaction() as cursor:
+        # Field names come from the registry (validate_fields only returns known fields), never from the request
+        cursor.execute(PATCH_LOG.format(assignments=", ".join(f"{field} = %s" for field in values), key=key), tuple(values.values()) + params + (user, types))
+        updated = cursor.fetchone()
+        if updated is not None:
+            refresh_daily_rollups(cursor, user, [updated[0].date()])
+        else:
+            # Nothing matched; find out why
+            cursor.execute(f"SELECT type, user_id FROM log WHERE {key}", params)
+            existing = cursor.fetchone()
+
+    if updated is None:
+        if existing is None:
+            return Responses.Not_Found_404(details="Log not found").build()
+        if existing[1] != user:
+            return Responses.Forbidden_403(details="You do not have permission to update this log").build()
+        return Responses.Bad_Request_400(details=f"Fields do not match this log's type ({existing[0]})").build()
+    return Responses.OK_200(data={"message": "Log updated successfully"}).build()
 
 @bp.put('/')
 @require_authentication
+@rate_limit('log_writes')
 def put_log():
     '''
     Create a new log.
@@ -177,108 +176,153 @@ def put_log():
         log_type = request.json['type']
     except KeyError:
         return Responses.Bad_Request_400(details="Log type is required").build()
-    
-    match log_type:
-        case 'daily':
-            try:
-                daily_muscle_soreness = request.json['daily_muscle_soreness']
-                daily_mood = request.json['daily_mood']
-                daily_stress_level = request.json['daily_stress_level']
-                notes = request.json.get('notes', '')
-            except KeyError as e:
-                return Responses.Bad_Request_400(details=f"Missing required field: {e.args[0]}").build()
-            
-            db.execute_query("INSERT INTO log (user_id, type, timestamp, updated, daily_muscle_soreness, daily_mood, daily_stress_level, notes) VALUES (%s, %s, NOW(), NOW(), %s, %s, %s, %s)", (
-                user,
-                'daily',
-                daily_muscle_soreness,
-                daily_mood,
-                daily_stress_level,
-                notes
-            ))
-            return Responses.Created_201(data={"message": "Daily log created successfully"}).build()
-        
-        case 'injury':
-            try:
-                injury_title = request.json['injury_title']
-                injury_state = request.json['injury_state']
-                injury_severity = request.json['injury_severity']
-                notes = request.json.get('notes', '')
-            except KeyError as e:
-                return Responses.Bad_Request_400(details=f"Missing required field: {e.args[0]}").build()
-            
-            db.execute_query("INSERT INTO log (user_id, type, timestamp, updated, injury_title, injury_state, injury_severity, notes) VALUES (%s, %s, NOW(), NOW(), %s, %s, %s, %s)", (
-                user,
-                'injury',
-                injury_title,
-                injury_state,
-                injury_severity,
-                notes
-            ))
-            return Responses.Created_201(data={"message": "Injury log created successfully"}).build()
-        
-        case 'activity':
-            try:
-                activity_duration_minutes = request.json['activity_duration_minutes']
-                activity_RPE = request.json['activity_RPE']
-                activity_related_id = request.json.get('activity_related_id', None)
-                notes = request.json.get('notes', '')
-            except KeyError as e:
-                return Responses.Bad_Request_400(details=f"Missing required field: {e.args[0]}").build()
-            
-            db.execute_query("INSERT INTO log (user_id, type, timestamp, updated, activity_duration_minutes, activity_RPE, activity_related_id, notes) VALUES (%s, %s, NOW(), NOW(), %s, %s, %s, %s)", (
-                user,
-                'activity',
-                activity_duration_minutes,
-                activity_RPE,
-                activity_related_id,
-                notes
-            ))
-            return Responses.Created_201(data={"message": "Activity log created successfully"}).build()
-        
-        case 'study':
-            try:
-                study_duration_minutes = request.json['study_duration_minutes']
-                notes = request.json.get('notes', '')
-            except KeyError as e:
-                return Responses.Bad_Request_400(details=f"Missing required field: {e.args[0]}").build()
-            
-            db.execute_query("INSERT INTO log (user_id, type, timestamp, updated, study_duration_minutes, notes) VALUES (%s, %s, NOW(), NOW(), %s, %s)", (
-                user,
-                'study',
-                study_duration_minutes,
-                notes
-            ))
-            return Responses.Created_201(data={"message": "Study log created successfully"}).build()
-        
-        case 'sleep':
-            try:
-                sleep_quality = request.json['sleep_quality']
-                sleep_duration_minutes = request.json['sleep_duration_minutes']
-                notes = request.json.get('notes', '')
-            except KeyError as e:
-                return Responses.Bad_Request_400(details=f"Missing required field: {e.args[0]}").build()
-            db.execute_query("INSERT INTO log (user_id, type, timestamp, updated, sleep_quality, sleep_duration_minutes, notes) VALUES (%s, %s, NOW(), NOW(), %s, %s, %s)", (
-                user,
-                'sleep',
-                sleep_quality,
-                sleep_duration_minutes,
-                notes
-            ))
-            return Responses.Created_201(data={"message": "Sleep log created successfully"}).build()
-
-        case _:
-            return Responses.Bad_Request_400(details="Invalid log type").build()
+    if log_type not in LOG_TYPES:
+        return Responses.Bad_Request_400(details="Invalid log type").build()
+    try: values = validate_fields(request.json, LOG_TYPES[log_type])
+    except ValueError as e: return Responses.Bad_Request_400(details=str(e)).build()
+
+    with db.transaction() as cursor:
+        cursor.execute(INSERT_LOG[log_type], (user, log_type) + tuple(values.values()))
+        day = cursor.fetchone()[0].date()
+        refresh_daily_rollups(cursor, user, [day])
+        if log_type == STREAK_LOG_TYPE:
+            record_daily_log(cursor, user, day)
+    return Responses.Created_201(data={"message": f"{log_type.capitalize()} log created successfully"}).build()
+
+def validate_fields(entry, fields, partial=False):
+    '''
+    Check the values in `entry` for `fields` (field name -> python type).
+    Returns a value for every field, or with partial=True only for the fields present.
+    Raises ValueError with a description of the problem if a value is missing or has the wrong type.
+    '''
+    values = {}
+    for field, field_type in fields.items():
+        if field not in entry:
+            if partial:
+                continue
+            if field not in OPTIONAL_FIELDS:
+                raise ValueError(f"Missing required field: {field}")
+            values[field] = OPTIONAL_FIELDS[field]
+            continue
+        value = entry[field]
+        if value is not None and (not isinstance(value, field_type) or isinstance(value, bool)):
+            raise ValueError(f"Invalid value for field: {field}")
+        values[field] = value
+    return values
+
+def validate_log(entry):
+    '''
+    Validate a single log entry against its type.
+    Returns the log type, the timestamp (or None for now) and a value for every field of that type.
+    Raises ValueError with a description of the problem if the entry is invalid.
+    '''
+    if not isinstance(entry, dict):
+        raise ValueError("Log must be an object")
+    log_type = entry.get('type')
+    if log_type not in LOG_TYPES:
+        raise ValueError("Invalid log type")
+
+    values = validate_fields(entry, LOG_TYPES[log_type])
+
+    timestamp = entry.get('timestamp')
+    if timestamp is not None:
+        try: timestamp = dt.datetime.fromisoformat(timestamp)
+        except (TypeError, ValueError): raise ValueError("Invalid timestamp, must be in ISO 8601 format")
+    return log_type, timestamp, values
+
+def batch_size():
+    '''
+    Number of logs in a batch request, so each log in a batch counts towards the write rate limit.
+    '''
+    body = request.get_json(silent=True)
+    logs = body.get('logs') if isinstance(body, dict) else None
+    return max(len(logs), 1) if isinstance(logs, list) else 1
+
+@bp.put('/batch')
+@require_authentication
+@rate_limit('log_writes', cost=batch_size)
+def put_log_batch():
+    '''
+    Create many logs, of any mix of types, in one request.
+    Valid logs are written in a single transaction; each entry gets either an id or an error back.
+    '''
+    user = current_user(request)
+
+    logs = request.json.get('logs')
+    try: assert isinstance(logs, list) and 0 < len(logs) <= BATCH_LIMIT
+    except AssertionError: return Responses.Bad_Request_400(details=f"logs must be a list of 1 to {BATCH_LIMIT} logs").build()
+
+    results = [None] * len(logs)
+    rows = []
+    indexes = []
+    for index, entry in enumerate(logs):
+        try: log_type, timestamp, values = validate_log(entry)
+        except ValueError as e:
+            results[index] = {"index": index, "error": str(e)}
+            continue
+        rows.append((user, log_type, timestamp) + tuple(values.get(column) for column in LOG_COLUMNS))
+        indexes.append(index)
+
+    if rows:
+        with db.transaction() as cursor:
+            inserted = execute_values(
+                cursor,
+                f"INSERT INTO log (user_id, type, timestamp, updated, {', '.join(LOG_COLUMNS)}) VALUES %s RETURNING id, timestamp",
+                rows,
+                template="(%s, %s, COALESCE(%s, NOW()), NOW(), " + ", ".join(["%s"] * len(LOG_COLUMNS)) + ")",
+                page_size=len(rows),
+                fetch=True
+            )
+            refresh_daily_rollups(cursor, user, {timestamp.date() for _, timestamp in inserted})
+            # Streaks only move forward one day at a time, so count each daily-log day in order
+            for day in sorted({timestamp.date() for row, (_, timestamp) in zip(rows, inserted) if row[1] == STREAK_LOG_TYPE}):
+                record_daily_log(cursor, user, day)
+        for index, (log_id, _) in zip(indexes, inserted):
+            results[index] = {"index": index, "id": log_id}
+
+    g.logs_written = len(rows)
+    data = {"created": len(rows), "failed": len(logs) - len(rows), "results": results}
+    if not rows:
+        return Responses.Bad_Request_400(details="No valid logs in batch", data=data).build()
+    return Responses.Created_201(data=data).build()
+
+def page_logs(query, sort, limit, cursor=None):
+    '''
+    One page of logs matching a LogQuery, in (timestamp, id) order, starting after `cursor`.
+    Returns the logs and the cursor for the next page (None on the last page).
+    '''
+    after = decode_cursor(cursor, sort) if cursor is not None else None
+    sql, params = query.select(sort=sort, limit=limit + 1, after=after)
+    logs = db.execute_query_fetchall(sql, tuple(params))
+    next_cursor = None
+    if len(logs) > limit:
+        logs = logs[:limit]
+        next_cursor = encode_cursor(logs[-1][3], logs[-1][0], sort)
+    return logs, next_cursor
+
+def parse_timestamp(value):
+    '''
+    Parse an ISO date or datetime from a request. Raises ValueError if it isn't one.
+    '''
+    if not isinstance(value, str): raise ValueError(value)
+    return dt.datetime.fromisoformat(value)
 
 @bp.get('/')
 @require_authentication
 def filter_log():
     '''
-    Filter logs based on query parameters.
-    Example query parameters:
-    - filter: user_id, date, log_type
+    Filter logs based on query parameters. The filters below combine freely:
+    - user_ids: list of user ids
+    - group: group id (logs of its students)
+    - types: list of log types
+    - start, end: ISO dates or datetimes, start inclusive and end exclusive
+    Legacy single filter (applied on top of the above):
+    - filter: user_id, date, log_type, with the matching user_id/date/log_type parameter
+    Paging:
     - limit: number of results
     - sort: asc/desc
+    - cursor: next_cursor from the previous page
+    Students only see their own logs: they may not filter by group, and user_ids may only hold their own id.
     '''
     filter: str = request.json.get('filter', None)
     try: assert filter is None or (isinstance(filter, str) and filter in ['user_id', 'date', 'log_type'])
@@ -292,29 +336,65 @@ def filter_log():
     try: assert sort in ['asc', 'desc']
     except AssertionError: return Responses.Bad_Request_400(details="Invalid sort parameter, must be 'asc' or 'desc'").build()
     
+    cursor = request.json.get('cursor', None)
+    try: assert cursor is None or isinstance(cursor, str)
+    except AssertionError: return Responses.Bad_Request_400(details="Invalid cursor parameter").build()
+
+    user_ids = request.json.get('user_ids', None)
+    group = request.json.get('group', None)
+    types = request.json.get('types', None)
+    start = request.json.get('start', None)
+    end = request.json.get('end', None)
+
     match filter:
-        case None:
-            logs = db.execute_query_fetchall(f"SELECT * FROM log ORDER BY timestamp {sort.upper()} LIMIT %s", (limit,))
-            return Responses.OK_200(data={"logs": logs}).build()
         case 'user_id':
             user_id: int = request.json.get('user_id', None)
-            try: assert isinstance(user_id, int)
+            try: assert isinstance(user_id, int) and user_ids is None
             except AssertionError: return Responses.Bad_Request_400(details="Invalid user_id parameter").build()
 
-            logs = db.execute_query_fetchall(f"SELECT * FROM log WHERE user_id = %s ORDER BY timestamp {sort.upper()} LIMIT %s", (user_id, limit))
-            return Responses.OK_200(data={"logs": logs}).build()
+            user_ids = [user_id]
         case 'date':
             date: str = request.json.get('date', None)
-            try: assert isinstance(date, str)
-            except AssertionError: return Responses.Bad_Request_400(details="Invalid date parameter").build()
-
-            logs = db.execute_query_fetchall(f"SELECT * FROM log WHERE DATE(timestamp) = %s ORDER BY timestamp {sort.upper()} LIMIT %s", (date, limit))
-            return Responses.OK_200(data={"logs": logs}).build()
+            try:
+                assert start is None and end is None
+                start = dt.date.fromisoformat(date).isoformat()
+                end = (dt.date.fromisoformat(date) + dt.timedelta(days=1)).isoformat()
+            except (AssertionError, TypeError, ValueError): return Responses.Bad_Request_400(details="Invalid date parameter").build()
         case 'log_type':
             log_type: str = request.json.get('log_type', None)
-            try: assert isinstance(log_type, str) and log_type in ['daily', 'injury', 'activity', 'study']
+            try: assert isinstance(log_type, str) and log_type in LOG_TYPES and types is None
             except AssertionError: return Responses.Bad_Request_400(details="Invalid log_type parameter").build()
 
-            logs = db.execute_query_fetchall(f"SELECT * FROM log WHERE type = %s ORDER BY timestamp {sort.upper()} LIMIT %s", (log_type, limit))
-            return Responses.OK_200(data={"logs": logs}).build()
-    pass
\ No newline at end of file
+            types = [log_type]
+
+    query = LogQuery()
+    if user_ids is not None:
+        try: assert isinstance(user_ids, list) and user_ids and all(isinstance(user_id, int) for user_id in user_ids)
+        except AssertionError: return Responses.Bad_Request_400(details="Invalid user_ids parameter, must be a non-empty list of user ids").build()
+    identity = current_identity()
+    if identity is None:
+        return Responses.Unauthorized_401(details="User not found").build()
+    if identity['type'] == 'student':
+        if group is not None or (user_ids is not None and set(user_ids) != {identity['id']}):
+            return Responses.Forbidden_403(details="Students can only view their own logs").build()
+        user_ids = [identity['id']]
+    if user_ids is not None:
+        query.users(user_ids)
+    if group is not None:
+        try: assert isinstance(group, int)
+        except AssertionError: return Responses.Bad_Request_400(details="Invalid group parameter").build()
+        query.group(group)
+    if types is not None:
+        try: assert isinstance(types, list) and types and all(log_type in LOG_TYPES for log_type in types)
+        except (AssertionError, TypeError): return Responses.Bad_Request_400(details=f"Invalid types parameter, must be a non-empty list of {', '.join(LOG_TYPES)}").build()
+        query.types(types)
+    if start is not None or end is not None:
+        try:
+            start = parse_timestamp(start) if start is not None else None
+            end = parse_timestamp(end) if end is not None else None
+        except ValueError: return Responses.Bad_Request_400(details="Invalid start or end parameter, must be an ISO date or datetime").build()
+        query.between(start, end)
+
+    try: logs, next_cursor = page_logs(query, sort, limit, cursor)
+    except ValueError as e: return Responses.Bad_Request_400(details=str(e)).build()
+    return Responses.OK_200(data={"logs": logs, "next_cursor": next_cursor}).build()
\ No newline at end of file
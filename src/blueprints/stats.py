@@ -10,12 +10,50 @@
 
 # IMPORTANT: This file will remain WIP until everything else is implemented.
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, stream_with_context
 import datetime as dt
-from __main__ import db, app, require_authentication, require_type, Responses, current_user
+import logging
+from __main__ import db, app, ts, require_authentication, require_type, Responses, current_user
+from responses import version_etag
+from db import add_months
+from rollups import METRICS, period_stats, rollup_version
+from analytics import cohort_stats
+from streaks import get_streak, freeze
+from log_query import LogQuery
+from membership import GROUP_STUDENTS
+from exports import csv_chunks, parquet_chunks
+from blueprints.logs import LOG_TYPES, LOG_COLUMNS, FIELD_TYPES
+
+logger = logging.getLogger(__name__)
 
 bp = Blueprint('stats', __name__, url_prefix="/stats")
 
+def requested_date():
+    '''
+    Read the optional "date" (YYYY-MM-DD) from the request body, defaulting to today.
+    Raises ValueError if it is malformed.
+    '''
+    if request.mimetype == 'application/json' and "date" in request.json:
+        try: return dt.date.fromisoformat(request.json["date"])
+        except (TypeError, ValueError): raise ValueError("Date must be in YYYY-MM-DD format")
+    return dt.datetime.now(tz=app.config['TZ_OBJ']).date()
+
+def requested_range(default_days=28, max_days=366):
+    '''
+    Read the optional inclusive "start" and "end" dates (YYYY-MM-DD) from the request body.
+    Defaults to the last `default_days` days, ending today. Returns a half-open (start, end) pair.
+    Raises ValueError if either is malformed or the range is empty or too long.
+    '''
+    body = request.json if request.mimetype == 'application/json' else {}
+    today = dt.datetime.now(tz=app.config['TZ_OBJ']).date()
+    try:
+        end = dt.date.fromisoformat(body["end"]) if "end" in body else today
+        start = dt.date.fromisoformat(body["start"]) if "start" in body else end - dt.timedelta(days=default_days - 1)
+    except (TypeError, ValueError): raise ValueError("Dates must be in YYYY-MM-DD format")
+    if not 0 <= (end - start).days < max_days:
+        raise ValueError(f"Date range must cover between 1 and {max_days} days")
+    return start, end + dt.timedelta(days=1)
+
 # Individual Stats
 @bp.get('/individual/daily/<int:user_id>')
 @require_authentication
@@ -32,8 +70,24 @@ def get_individual_daily_stats(user_id):
         except AssertionError: return Responses.Bad_Request_400(details="Date must be in YYYY-MM-DD format").build()
     else: date = (dt.datetime.now(tz=app.config['TZ_OBJ']) - dt.timedelta(days=1)).strftime('%Y-%m-%d')
 
-    try: daily_log = db.execute_query_fetchall("SELECT id, timestamp, updated, daily_sleep_quality, daily_muscle_soreness, daily_mood, daily_stress_level, notes FROM log WHERE user_id = %s AND DATE(timestamp) = %s AND type = 'daily'",(user_id, date))[0]
-    except IndexError: return Responses.Not_Found_404(details="No daily log found").build()
+    return daily_log_response(user_id, date)
+
+# A user's daily log for a day. Daily logs don't record sleep, so daily_sleep_quality comes from that day's sleep log
+DAILY_LOG = '''
+    SELECT d.id, d.timestamp, d.updated, sleep.sleep_quality, d.daily_muscle_soreness, d.daily_mood, d.daily_stress_level, d.notes
+    FROM log d
+    LEFT JOIN LATERAL (
+        SELECT sleep_quality FROM log
+        WHERE user_id = d.user_id AND type = 'sleep' AND timestamp >= %(date)s::date AND timestamp < %(date)s::date + 1
+        ORDER BY timestamp DESC, id DESC LIMIT 1
+    ) sleep ON TRUE
+    WHERE d.user_id = %(user_id)s AND d.type = 'daily' AND d.timestamp >= %(date)s::date AND d.timestamp < %(date)s::date + 1
+    ORDER BY d.timestamp DESC, d.id DESC LIMIT 1
+'''
+
+def daily_log_response(user_id, date):
+    daily_log = db.execute_query_fetchone(DAILY_LOG, {"user_id": user_id, "date": date})
+    if daily_log is None: return Responses.Not_Found_404(details="No daily log found").build()
 
     return Responses.OK_200(data={
         "id": daily_log[0],
@@ -52,9 +106,12 @@ def get_individual_daily_stats(user_id):
 def get_individual_weekly_stats(user_id):
     '''
     Retrieve weekly performance stats for a specific user.
+    Covers the Monday-Sunday week containing the requested date (default today).
     '''
-    # TODO: Implement function
-    pass
+    try: date = requested_date()
+    except ValueError as e: return Responses.Bad_Request_400(details=str(e)).build()
+    start = date - dt.timedelta(days=date.weekday())
+    return period_stats_response(user_id, start, start + dt.timedelta(days=7))
 
 @bp.get('/individual/monthly/<int:user_id>')
 @require_authentication
@@ -62,9 +119,17 @@ def get_individual_weekly_stats(user_id):
 def get_individual_monthly_stats(user_id):
     '''
     Retrieve monthly performance stats for a specific user.
+    Covers the calendar month containing the requested date (default today).
     '''
-    # TODO: Implement function
-    pass
+    try: date = requested_date()
+    except ValueError as e: return Responses.Bad_Request_400(details=str(e)).build()
+    start = date.replace(day=1)
+    return period_stats_response(user_id, start, add_months(start, 1))
+
+def period_stats_response(user_id, start, end):
+    etag = version_etag("period", user_id, start, end, *rollup_version(db, [user_id], start, end))
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
+    return Responses.OK_200(data=period_stats(db, user_id, start, end)).with_etag(etag).build()
 
 @bp.get('/individual/lifetime/<int:user_id>')
 @require_authentication
@@ -73,41 +138,29 @@ def get_individual_lifetime_stats(user_id):
     '''
     Retrieve lifetime performance stats for a specific user.
     '''
-    try: user = db.execute_query_fetchall("SELECT id FROM users WHERE id = %s", (user_id,))[0]
-    except IndexError: return Responses.Not_Found_404(details="User not found").build
+    etag = version_etag("lifetime", user_id, *rollup_version(db, [user_id]))
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
 
-    logs = db.execute_query_fetchall("SELECT id, timestamp, updated, daily_sleep_quality, daily_muscle_soreness, daily_mood, daily_stress_level, notes FROM log WHERE user_id = %s AND type = 'daily' ORDER BY timestamp ASC",(user_id,))
-    try: logs[0]
-    except IndexError: return Responses.Not_Found_404(details="No logs found for user").build()
+    aggregates = ", ".join(
+        f"AVG(log.{metric})::float, MIN(log.{metric}), MAX(log.{metric}), percentile_cont(0.5) WITHIN GROUP (ORDER BY log.{metric})"
+        for metric in METRICS
+    )
+    row = db.execute_query_fetchone(
+        f"SELECT COUNT(log.id), mode() WITHIN GROUP (ORDER BY log.daily_mood), {aggregates} FROM users LEFT JOIN log ON log.user_id = users.id WHERE users.id = %s GROUP BY users.id",
+        (user_id,)
+    )
+    if row is None: return Responses.Not_Found_404(details="User not found").build()
+    if row[0] == 0: return Responses.Not_Found_404(details="No logs found for user").build()
 
     stats = {
         "user_id": user_id,
-        "logs": len(logs),
-        "daily_sleep_quality": {
-            "average": sum(log[3] for log in logs if log[3] is not None) / len([log for log in logs if log[3] is not None]),
-            "min": min(log[3] for log in logs if log[3] is not None),
-            "max": max(log[3] for log in logs if log[3] is not None),
-            "median": sorted([log[3] for log in logs if log[3] is not None])[len([log for log in logs if log[3] is not None]) // 2]
-        },
-        "daily_muscle_soreness": {
-            "average": sum(log[4] for log in logs if log[4] is not None) / len([log for log in logs if log[4] is not None]),
-            "min": min(log[4] for log in logs if log[4] is not None),
-            "max": max(log[4] for log in logs if log[4] is not None),
-            "median": sorted([log[4] for log in logs if log[4] is not None])[len([log for log in logs if log[4] is not None]) // 2]
-        },
-        "daily_mood": {
-            "average": sum(log[5] for log in logs if log[5] is not None) / len([log for log in logs if log[5] is not None]),
-            "min": min(log[5] for log in logs if log[5] is not None),
-            "max": max(log[5] for log in logs if log[5] is not None),
-            "median": sorted([log[5] for log in logs if log[5] is not None])[len([log for log in logs if log[5] is not None]) // 2]
-        },
-        "daily_stress_level": {
-            "average": sum(log[6] for log in logs if log[6] is not None) / len([log for log in logs if log[6] is not None]),
-            "min": min(log[6] for log in logs if log[6] is not None),
-            "max": max(log[6] for log in logs if log[6] is not None),
-            "median": sorted([log[6] for log in logs if log[6] is not None])[len([log for log in logs if log[6] is not None]) // 2]
-        }
+        "logs": row[0],
+        "daily_mood": {"mode": row[1]}
     }
+    for i, metric in enumerate(METRICS):
+        average, minimum, maximum, median = row[2 + i * 4:6 + i * 4]
+        stats[metric] = {"average": average, "min": minimum, "max": maximum, "median": median}
+    return Responses.OK_200(data=stats).with_etag(etag).build()
 
 # My Stats
 @bp.get('/individual/daily/me')
@@ -116,7 +169,7 @@ def get_my_daily_stats():
     '''
     Retrieve daily performance stats for the authenticated user.
     '''
-    user_id = current_user()
+    user_id = current_user(request)
     if request.mimetype == 'application/json':
         try: 
             date = request.json["date"]
@@ -125,19 +178,7 @@ def get_my_daily_stats():
         except AssertionError: return Responses.Bad_Request_400(details="Date must be in YYYY-MM-DD format").build()
     else: date = (dt.datetime.now(tz=app.config['TZ_OBJ']) - dt.timedelta(days=1)).strftime('%Y-%m-%d')
 
-    try: daily_log = db.execute_query_fetchall("SELECT id, timestamp, updated, daily_sleep_quality, daily_muscle_soreness, daily_mood, daily_stress_level, notes FROM log WHERE user_id = %s AND DATE(timestamp) = %s AND type = 'daily'",(user_id, date))[0]
-    except IndexError: return Responses.Not_Found_404(details="No daily log found").build()
-
-    return Responses.OK_200(data={
-        "id": daily_log[0],
-        "timestamp": daily_log[1],
-        "updated": daily_log[2],
-        "daily_sleep_quality": daily_log[3],
-        "daily_muscle_soreness": daily_log[4],
-        "daily_mood": daily_log[5],
-        "daily_stress_level": daily_log[6],
-        "notes": daily_log[7]
-    }).build()
+    return daily_log_response(user_id, date)
 
 
 # Group Stats
@@ -147,8 +188,10 @@ def get_my_daily_stats():
 def get_group_stats(group_id):
     '''
     Retrieve performance stats for a group.
+    Returns per-day mean and percentile bands for every metric across the group's students,
+    as arrays aligned with "days", plus each student's mean aligned with "athletes".
     '''
-    pass
+    return group_stats_response(group_id, list(METRICS))
 
 @bp.get('/group/<int:group_id>/<field>')
 @require_authentication
@@ -157,17 +200,54 @@ def get_group_stats_field(group_id, field):
     '''
     Retrieve specific field performance stats for a group.
     '''
-    pass
+    if field not in METRICS: return Responses.Not_Found_404(details="Unknown stats field").build()
+    return group_stats_response(group_id, [field])
+
+def group_stats_response(group_id, metrics):
+    try: start, end = requested_range()
+    except ValueError as e: return Responses.Bad_Request_400(details=str(e)).build()
+
+    group = db.execute_query_fetchone(f"SELECT {GROUP_STUDENTS}, updated FROM groups WHERE id = %s", (group_id,))
+    if group is None: return Responses.Not_Found_404(details="Group not found").build()
+
+    etag = version_etag("group", group_id, group[1], start, end, ",".join(metrics), *rollup_version(db, group[0], start, end))
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
+    return Responses.OK_200(data={"group_id": group_id} | cohort_stats(db, group[0], start, end, metrics)).with_etag(etag).build()
 
 # Org Stats
+def org_stats_response(field=None):
+    '''
+    Serve the precomputed org stats snapshot, or 304 if the client already has it.
+    '''
+    snapshot = db.execute_query_fetchone("SELECT etag, generated_at FROM stats_snapshots WHERE scope = 'org'")
+    if snapshot is None:
+        try: ts.refresh_org_stats.delay()
+        except Exception as e:
+            logger.warning("Could not queue org stats refresh: %s", e)
+            return Responses.Service_Unavailable_503(details="Org stats are not available yet, try again later", retry_after=60).build()
+        return Responses.Accepted_202(data={"details": "Org stats are being generated, try again shortly"}).build()
+
+    etag, generated_at = snapshot
+    if field is not None:
+        etag = f"{etag}-{field}"
+    if (not_modified := Responses.not_modified(etag)): return not_modified.build()
+
+    # The payload is sent as stored; for a single field only that metric is kept, in SQL
+    payload = db.execute_query_fetchone(
+        "SELECT (CASE WHEN %(field)s::text IS NULL THEN payload ELSE jsonb_set(payload, '{metrics}', jsonb_build_object(%(field)s::text, payload->'metrics'->%(field)s::text)) END)::text FROM stats_snapshots WHERE scope = 'org'",
+        {"field": field}
+    )[0]
+    return Responses.OK_200.from_json(payload, data={"generated_at": generated_at.isoformat()}).with_etag(etag).build()
+
 @bp.get('/org')
 @require_authentication
 # Available to all authenticated users
 def get_org_stats():
     '''
     Retrieve organization-wide performance stats.
+    Served from a snapshot refreshed by the task server; supports If-None-Match.
     '''
-    pass
+    return org_stats_response()
 
 @bp.get('/org/<field>')
 @require_authentication
@@ -176,7 +256,8 @@ def get_org_stats_field(field):
     '''
     Retrieve specific field organization-wide performance stats.
     '''
-    pass
+    if field not in METRICS: return Responses.Not_Found_404(details="Unknown stats field").build()
+    return org_stats_response(field)
 
 # Data Export and Streaks
 @bp.get('/export')
@@ -185,8 +266,41 @@ def get_org_stats_field(field):
 def export_stats():
     '''
     Export stats data.
+    Streams raw logs as CSV (default) or Parquet (format=parquet), optionally filtered by
+    group, user (repeatable), type (repeatable) and an inclusive start/end date, all given as query parameters.
     '''
-    pass
+    export_format = request.args.get('format', 'csv')
+    try: assert export_format in ['csv', 'parquet']
+    except AssertionError: return Responses.Bad_Request_400(details="Invalid format, must be 'csv' or 'parquet'").build()
+
+    query = LogQuery()
+    try:
+        if 'group' in request.args:
+            query.group(int(request.args['group']))
+        if 'user' in request.args:
+            query.users([int(user_id) for user_id in request.args.getlist('user')])
+        if 'type' in request.args:
+            types = request.args.getlist('type')
+            assert all(log_type in LOG_TYPES for log_type in types)
+            query.types(types)
+        start = dt.date.fromisoformat(request.args['start']) if 'start' in request.args else None
+        end = dt.date.fromisoformat(request.args['end']) + dt.timedelta(days=1) if 'end' in request.args else None
+        query.between(start, end)
+    except (ValueError, AssertionError): return Responses.Bad_Request_400(details="Invalid export filter").build()
+
+    columns = ['id', 'user_id', 'type', 'timestamp', 'updated'] + LOG_COLUMNS
+    types = {'id': int, 'user_id': int, 'type': str, 'timestamp': 'timestamp', 'updated': 'timestamp'}
+    types.update(FIELD_TYPES)
+    chunks = db.stream_query(*query.select(columns=', '.join(columns)))
+
+    filename = f"logs-{dt.date.today().isoformat()}.{export_format}"
+    if export_format == 'parquet':
+        body, mimetype = parquet_chunks(chunks, columns, types), 'application/vnd.apache.parquet'
+    else:
+        body, mimetype = csv_chunks(chunks, columns), 'text/csv'
+    return app.response_class(stream_with_context(body), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename={filename}"
+    })
 
 @bp.get('/streaks/<int:user_id>')
 @require_authentication
@@ -195,7 +309,9 @@ def get_user_streaks(user_id):
     '''
     Retrieve streaks for a user.
     '''
-    pass
+    streak = get_streak(db, user_id)
+    if streak is None: return Responses.Not_Found_404(details="User not found").build()
+    return Responses.OK_200(data=streak).build()
 
 @bp.get('/streaks/me')
 @require_authentication
@@ -203,9 +319,35 @@ def get_my_streaks():
     '''
     Retrieve streaks for the authenticated user.
     '''
-    pass
+    return Responses.OK_200(data=get_streak(db, current_user(request))).build()
 
 # Streak Freeze
+def requested_until():
+    '''
+    Read the optional inclusive "until" date (YYYY-MM-DD) from the request body, or None for an indefinite freeze.
+    Raises ValueError if it is malformed or in the past.
+    '''
+    body = request.json if request.mimetype == 'application/json' else {}
+    if body.get("until") is None:
+        return None
+    try: until = dt.date.fromisoformat(body["until"])
+    except (TypeError, ValueError): raise ValueError("Until must be in YYYY-MM-DD format")
+    if until < dt.datetime.now(tz=app.config['TZ_OBJ']).date():
+        raise ValueError("Until must not be in the past")
+    return until
+
+def freeze_response(scope, target_id=None):
+    try: until = requested_until()
+    except ValueError as e: return Responses.Bad_Request_400(details=str(e)).build()
+    freeze_id = freeze(db, scope, target_id, until, current_user(request))
+    if freeze_id is None: return Responses.Not_Found_404(details=f"{scope.capitalize()} not found").build()
+    return Responses.Created_201(data={
+        "id": freeze_id,
+        "scope": scope,
+        "target_id": target_id,
+        "until": until.isoformat() if until else None
+    }).build()
+
 @bp.post('/streaks/freeze/user/<int:user_id>')
 @require_authentication
 @require_type('teacher')
@@ -213,7 +355,7 @@ def freeze_user_streak(user_id):
     '''
     Freeze streak for a user, either until specified date or indefinitely.
     '''
-    pass
+    return freeze_response('user', user_id)
 
 @bp.post('/streaks/freeze/group/<int:group_id>')
 @require_authentication
@@ -222,7 +364,7 @@ def freeze_group_streak(group_id):
     '''
     Freeze streak for a group, either until specified date or indefinitely.
     '''
-    pass
+    return freeze_response('group', group_id)
 
 @bp.post('/streaks/freeze/deepfreeze')
 @require_authentication
@@ -231,7 +373,7 @@ def freeze_org_streak():
     '''
     Freeze streak for the entire organization, either until specified date or indefinitely.
     '''
-    pass
+    return freeze_response('org')
 
 # Admin Stats Management
 @bp.delete('/reset/<int:user_id>')
@@ -2,62 +2,352 @@
 import json
 import os
 import logging
+import importlib
+import threading
+import time
+import datetime as dt
+from contextlib import contextmanager
 
 import psycopg2
+import psycopg2.pool
 logger = logging.getLogger(__name__)
 
-class Database:
-    def __init__(self, connection: psycopg2.extensions.connection):
-        self.connection = connection
+# Key for the advisory lock held while migrating, so concurrently booting servers apply each migration once
+MIGRATION_LOCK_ID = 7261001
 
-    def execute_query(self, query, params=None):
-        cursor = self.connection.cursor()
+def add_months(month: dt.date, months: int) -> dt.date:
+    '''
+    Return the first day of the month `months` after the month containing `month`.
+    '''
+    index = month.year * 12 + month.month - 1 + months
+    return dt.date(index // 12, index % 12 + 1, 1)
+
+def log_partition_name(month: dt.date) -> str:
+    return f"log_{month.year:04d}_{month.month:02d}"
+
+class PoolTimeout(Exception):
+    '''
+    Raised when no connection could be checked out of the pool in time.
+    '''
+    pass
+
+class ConnectionPool:
+    '''
+    Bounded, thread-safe pool of psycopg2 connections.
+
+    Callers block for up to `timeout` seconds when every connection is checked out,
+    and connections that have been idle for longer than `healthcheck_interval` seconds
+    are pinged before being handed out.
+    '''
+    def __init__(self, minconn, maxconn, timeout=10.0, healthcheck_interval=30.0, **connect_kwargs):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.stats = {
+            "checkouts": 0,
+            "in_use": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "replaced": 0
+        }
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
         try:
-            cursor.execute(query, params or ())
-        except psycopg2.ProgrammingError as e:
-            pass
-        except Exception as e:
-            logger.error("Database query failed: %s", e)
-            raise
-        finally:
-            cursor.close()
-    
-    def execute_query_fetchall(self, query, params=None):
-        cursor = self.connection.cursor()
+            conn.autocommit = True
+            if time.monotonic() - self._last_used.get(id(conn), 0) < self.healthcheck_interval:
+                return True
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            logger.error("Timed out waiting %.1fs for a database connection", self.timeout)
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        waited = time.perf_counter() - start
         try:
-            cursor.execute(query, params or ())
-            results = cursor.fetchall()
-            return results
-        except psycopg2.ProgrammingError as e:
-            return []
-        except Exception as e:
-            logger.error("Database query failed: %s", e)
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                logger.warning("Discarding unhealthy database connection")
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+                conn.autocommit = True
+                with self._lock:
+                    self.stats["replaced"] += 1
+        except Exception:
+            self._slots.release()
             raise
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            if waited > 0.001:
+                self.stats["waits"] += 1
+            self.stats["wait_time_total"] += waited
+            self.stats["wait_time_max"] = max(self.stats["wait_time_max"], waited)
+        return conn
+
+    def putconn(self, conn):
+        try:
+            broken = bool(conn.closed)
+            if not broken and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try: conn.rollback()
+                except psycopg2.Error: broken = True
+            if broken: self._last_used.pop(id(conn), None)
+            else: self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=broken)
         finally:
-            cursor.close()
-        
-    def execute_query_fetchone(self, query, params=None):
-        cursor = self.connection.cursor()
+            with self._lock:
+                self.stats["in_use"] -= 1
+            self._slots.release()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["min_size"] = self.minconn
+        stats["max_size"] = self.maxconn
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        return stats
+
+    def closeall(self):
+        self._pool.closeall()
+
+class Database:
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+
+    @contextmanager
+    def connection(self):
+        '''
+        Check a connection out of the pool for the duration of the block.
+        '''
+        conn = self.pool.getconn()
         try:
-            cursor.execute(query, params or ())
-            result = cursor.fetchone()
-            return result
-        except psycopg2.ProgrammingError as e:
-            return None
-        except Exception as e:
-            logger.error("Database query failed: %s", e)
-            raise
+            yield conn
         finally:
-            cursor.close()
-    
-    def database_table_constructor(self):
+            self.pool.putconn(conn)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Run the block inside a single transaction, committing on success and rolling back on error.
+        Yields a cursor.
+        '''
+        with self.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn:
+                    with conn.cursor() as cursor:
+                        yield cursor
+            finally:
+                conn.autocommit = True
+
+    def stream_query(self, query, params=None, chunk_size=5000):
+        '''
+        Run a query through a server-side cursor and yield its rows in lists of up to `chunk_size`,
+        so large results never have to fit in memory. The connection stays checked out until the
+        generator is exhausted or closed.
+        '''
+        with self.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor(name=f"stream_{threading.get_ident()}_{time.monotonic_ns()}") as cursor:
+                    cursor.itersize = chunk_size
+                    cursor.execute(query, params or ())
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield rows
+            finally:
+                if not conn.closed:
+                    conn.rollback()
+                    conn.autocommit = True
+
+    def execute_query(self, query, params=None):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params or ())
+            except Exception as e:
+                logger.error("Database query failed: %s", e)
+                raise
+            finally:
+                cursor.close()
+
+    def execute_query_fetchall(self, query, params=None):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params or ())
+                # Statements that return no rows (e.g. an UPDATE without RETURNING) have nothing to fetch
+                if cursor.description is None:
+                    return []
+                return cursor.fetchall()
+            except Exception as e:
+                logger.error("Database query failed: %s", e)
+                raise
+            finally:
+                cursor.close()
+
+    def execute_query_fetchone(self, query, params=None):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params or ())
+                if cursor.description is None:
+                    return None
+                return cursor.fetchone()
+            except Exception as e:
+                logger.error("Database query failed: %s", e)
+                raise
+            finally:
+                cursor.close()
+
+    def migrate(self):
+        '''
+        Apply any pending migrations from the migrations package, in version order.
+        When the database is already up to date this costs a single version query.
+        '''
+        import migrations
+        modules = sorted(
+            (importlib.import_module(f"migrations.{module_name}") for module_name in migrations.modules),
+            key=lambda module: module.version
+        )
+        latest = modules[-1].version if modules else 0
+        # A new database has no schema_migrations table yet, and querying it would fail
+        current = None
+        if self.execute_query_fetchone("SELECT to_regclass('schema_migrations')")[0] is not None:
+            current = self.execute_query_fetchone("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        if current is not None and current[0] >= latest:
+            logger.info("Database schema is up to date (version %s).", current[0])
+            return
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version integer PRIMARY KEY, description text NOT NULL, applied_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            try:
+                cursor.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in cursor.fetchall()}
+                for module in modules:
+                    if module.version in applied:
+                        continue
+                    logger.info("Applying migration %s: %s", module.version, module.description)
+                    if getattr(module, "transactional", True):
+                        conn.autocommit = False
+                        try:
+                            with conn:
+                                module.upgrade(self, cursor)
+                                cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (module.version, module.description))
+                        finally:
+                            conn.autocommit = True
+                    else:
+                        module.upgrade(self, cursor)
+                        cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (module.version, module.description))
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                cursor.close()
+        logger.info("Database schema migrated to version %s.", latest)
+
+    def database_table_constructor(self, cursor=None):
+        '''
+        Create any missing tables and indexes from database_schema.json, the frozen baseline schema applied
+        by migration 0001 (later changes are migrations; the file is not kept in sync with them).
+        Top-level keys starting with "__" are notes, not tables.
+        Each table maps column names to their definitions, plus two optional reserved keys:
+        - "__constraints__": table constraint name -> definition, added to CREATE TABLE
+        - "__indexes__": index name -> index definition (columns/expressions, optionally prefixed with USING <method>)
+        '''
+        if cursor is None:
+            with self.connection() as conn:
+                with conn.cursor() as cursor:
+                    return self.database_table_constructor(cursor)
+
         schema = json.load(open(os.path.abspath(os.path.dirname(__file__)) + "/database_schema.json"))
-        cursor = self.connection.cursor()
         for table_name, table_def in schema.items():
+            if table_name.startswith("__"):
+                continue
+            table_def = dict(table_def)
+            constraints = table_def.pop("__constraints__", {})
+            indexes = table_def.pop("__indexes__", {})
             logger.debug("Ensuring table %s exists with definition: %s", table_name, table_def)
             columns_string = "("
             for column_name, column_type in table_def.items():
                 columns_string += f"{column_name} {column_type},"
+            for constraint_name, constraint_def in constraints.items():
+                columns_string += f"CONSTRAINT {constraint_name} {constraint_def},"
             columns_string = columns_string[:-1] + ");"
             cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} {columns_string}")
-        cursor.close()
\ No newline at end of file
+            for index_name, index_def in indexes.items():
+                logger.debug("Ensuring index %s exists on %s: %s", index_name, table_name, index_def)
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} {index_def}")
+
+    # Log partitions
+    def create_log_partition(self, cursor, month: dt.date):
+        '''
+        Create and attach the monthly partition of log containing `month`, if it does not exist.
+        Rows already sitting in the default partition for that month are moved into it.
+        '''
+        start = add_months(month, 0)
+        end = add_months(start, 1)
+        name = log_partition_name(start)
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        if cursor.fetchone()[0] is not None:
+            return False
+        logger.info("Creating log partition %s for [%s, %s)", name, start, end)
+        cursor.execute(f"CREATE TABLE {name} (LIKE log INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cursor.execute(f"WITH moved AS (DELETE FROM log_default WHERE timestamp >= %s AND timestamp < %s RETURNING *) INSERT INTO {name} SELECT * FROM moved", (start, end))
+        cursor.execute(f"ALTER TABLE log ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (start, end))
+        return True
+
+    def ensure_log_partitions(self, months_ahead=3):
+        '''
+        Make sure partitions exist for the current month and the next `months_ahead` months.
+        Returns the names of any partitions created.
+        '''
+        this_month = dt.date.today().replace(day=1)
+        created = []
+        for offset in range(months_ahead + 1):
+            month = add_months(this_month, offset)
+            with self.transaction() as cursor:
+                if self.create_log_partition(cursor, month):
+                    created.append(log_partition_name(month))
+        return created
+
+    def archive_log_partitions(self, retain_months):
+        '''
+        Detach monthly partitions older than `retain_months` months from log and move them
+        into the log_archive schema, where they stay queryable but drop out of every log scan.
+        Returns the names of any partitions archived.
+        '''
+        cutoff = add_months(dt.date.today().replace(day=1), -retain_months)
+        partitions = self.execute_query_fetchall(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'log'::regclass AND c.relname ~ '^log_[0-9]{4}_[0-9]{2}$'"
+        )
+        archived = []
+        for (name,) in sorted(partitions):
+            year, month = int(name[4:8]), int(name[9:11])
+            if dt.date(year, month, 1) >= cutoff:
+                continue
+            logger.info("Archiving log partition %s", name)
+            self.execute_query(f"ALTER TABLE log DETACH PARTITION {name}")
+            with self.transaction() as cursor:
+                cursor.execute("CREATE SCHEMA IF NOT EXISTS log_archive")
+                cursor.execute(f"ALTER TABLE {name} SET SCHEMA log_archive")
+            archived.append(name)
+        return archived
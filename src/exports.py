@@ -0,0 +1,72 @@
+# Exports
+#
+# Overview:
+# - Encode chunks of query rows as CSV or Parquet, one chunk at a time
+# - Used for streaming responses, so memory use stays flat however many rows are exported
+
+import csv
+import io
+
+def csv_chunks(chunks, columns):
+    '''
+    Encode an iterable of row lists as CSV, yielding one block of text per chunk.
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+class ChunkSink(io.RawIOBase):
+    '''
+    Write-only file that keeps what was written until it is drained.
+    '''
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def parquet_chunks(chunks, columns, types):
+    '''
+    Encode an iterable of row lists as a Parquet file, writing each chunk as a row group
+    and yielding the encoded bytes as they are produced.
+    `types` maps each column to int, str or "timestamp".
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {int: pa.int64(), str: pa.string(), "timestamp": pa.timestamp("us")}
+    schema = pa.schema([(column, arrow_types[types[column]]) for column in columns])
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for rows in chunks:
+            table = pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                schema=schema
+            )
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
@@ -0,0 +1,86 @@
+# Identity Cache
+#
+# Overview:
+# - Caches each user's type (role) and group memberships for authorization checks
+# - Entries live for a short TTL, in-process or in Redis (shared by every web server process)
+# - Anything that changes a user's type or groups must invalidate their entry
+
+import json
+import logging
+import threading
+import time
+from membership import USER_GROUPS
+
+logger = logging.getLogger(__name__)
+
+class IdentityCache:
+    '''
+    Short-lived cache of {"id", "type", "groups"} per user, loaded from the users table on a miss.
+
+    With a redis_url the entries are shared between processes, so an invalidation takes effect
+    everywhere at once; without one each process keeps its own copy (fine for a single process).
+    If Redis is unreachable lookups fall through to the database rather than failing the request.
+    '''
+    def __init__(self, db, ttl=60, redis_url=None, max_entries=10000):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.5)
+
+    def _key(self, user_id):
+        return f"identity:{user_id}"
+
+    def _load(self, user_id):
+        row = self.db.execute_query_fetchone(f"SELECT type, {USER_GROUPS} FROM users WHERE id = %s AND active", (user_id,))
+        if row is None:
+            return None
+        return {"id": user_id, "type": row[0], "groups": list(row[1])}
+
+    def get(self, user_id):
+        '''
+        Retrieve a user's identity, or None if the user does not exist or has been deactivated.
+        '''
+        if self._redis is not None:
+            try:
+                cached = self._redis.get(self._key(user_id))
+                if cached is not None:
+                    return json.loads(cached)
+            except Exception as e:
+                logger.warning("Identity cache lookup failed, using database: %s", e)
+                return self._load(user_id)
+            identity = self._load(user_id)
+            if identity is not None:
+                try: self._redis.set(self._key(user_id), json.dumps(identity), ex=self.ttl)
+                except Exception as e: logger.warning("Identity cache store failed: %s", e)
+            return identity
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        identity = self._load(user_id)
+        if identity is not None:
+            with self._lock:
+                if len(self._entries) >= self.max_entries:
+                    self._entries = {key: value for key, value in self._entries.items() if value[0] > now}
+                    if len(self._entries) >= self.max_entries:
+                        self._entries.clear()
+                self._entries[user_id] = (now + self.ttl, identity)
+        return identity
+
+    def invalidate(self, *user_ids):
+        '''
+        Drop the cached identities of the given users, e.g. after their type or groups change.
+        '''
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+        if self._redis is not None and user_ids:
+            try: self._redis.delete(*(self._key(user_id) for user_id in user_ids))
+            except Exception as e: logger.error("Identity cache invalidation failed: %s", e)
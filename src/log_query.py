@@ -0,0 +1,156 @@
+# Log Queries
+#
+# Overview:
+# - Composable filters over the log table: a set of users, a group, a set of types and a half-open timestamp range
+# - Compiles any combination into one parameterized SELECT, ordered by (timestamp, id), with optional keyset paging
+# - Each combination is planned against one of the log indexes (see INDEX_PLANS), which check_index_plans verifies at startup
+
+import base64, json
+import datetime as dt
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The index each combination of filters is served by, checked in order, with its leading columns; a group counts
+# as a set of users. Every index ends in timestamp, so the timestamp range bounds the index scan, and because the
+# log is partitioned by month the same range also prunes partitions.
+INDEX_PLANS = [
+    ({"users", "types"}, "log_user_id_type_timestamp_idx", ["user_id", "type", "timestamp"]),
+    ({"users"}, "log_user_id_timestamp_id_idx", ["user_id", "timestamp"]),
+    ({"types"}, "log_type_timestamp_id_idx", ["type", "timestamp"]),
+    (set(), "log_timestamp_id_idx", ["timestamp"])
+]
+
+INDEX_COLUMNS = '''
+    SELECT c.relname::text, array_agg(a.attname::text ORDER BY k.ord)
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+    WHERE i.indrelid = 'log'::regclass
+    GROUP BY c.relname
+'''
+
+def check_index_plans(db):
+    '''
+    Check that every index in INDEX_PLANS exists on the log and leads with the planned columns.
+    Returns the problems found (empty if none), each also logged as an error.
+    '''
+    indexes = {name: columns for name, columns in db.execute_query_fetchall(INDEX_COLUMNS)}
+    problems = []
+    for _, index, columns in INDEX_PLANS:
+        if index not in indexes:
+            problems.append(f"{index} does not exist")
+        elif indexes[index][:len(columns)] != columns:
+            problems.append(f"{index} is on {indexes[index]}, planned on {columns}")
+    for problem in problems:
+        logger.error("Log index plan: %s", problem)
+    return problems
+
+def encode_cursor(timestamp, log_id, sort):
+    '''
+    Opaque cursor for the position after a log, in the given sort order.
+    '''
+    return base64.urlsafe_b64encode(json.dumps([timestamp.isoformat(), log_id, sort]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor, sort):
+    '''
+    Decode a cursor from encode_cursor into (timestamp, id). Raises ValueError if it is malformed or for another sort order.
+    '''
+    try:
+        timestamp, log_id, cursor_sort = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        timestamp = dt.datetime.fromisoformat(timestamp)
+        assert isinstance(log_id, int) and cursor_sort == sort
+    except Exception: raise ValueError("Invalid cursor")
+    return timestamp, log_id
+
+class LogQuery:
+    '''
+    Builder for log queries. Filters combine with AND; each may be set at most once.
+
+        query = LogQuery().group(3).types(['injury', 'activity']).between(start, end)
+        sql, params = query.select(sort='desc', limit=50)
+    '''
+    def __init__(self):
+        self.user_ids = None
+        self.group_id = None
+        self.log_types = None
+        self.start = None
+        self.end = None
+
+    def users(self, user_ids):
+        self.user_ids = sorted(set(user_ids))
+        return self
+
+    def group(self, group_id):
+        '''
+        Logs of the group's students.
+        '''
+        self.group_id = group_id
+        return self
+
+    def types(self, log_types):
+        self.log_types = sorted(set(log_types))
+        return self
+
+    def between(self, start=None, end=None):
+        '''
+        Logs with start <= timestamp < end; either bound may be None. Dates mean midnight.
+        '''
+        self.start = start
+        self.end = end
+        return self
+
+    @property
+    def index(self):
+        '''
+        The index this query is planned against.
+        '''
+        filters = set()
+        if self.user_ids is not None or self.group_id is not None:
+            filters.add("users")
+        if self.log_types is not None:
+            filters.add("types")
+        return next(index for required, index, _ in INDEX_PLANS if required <= filters)
+
+    def where(self, sort='asc', after=None):
+        '''
+        The WHERE clause (possibly empty) and its parameters. `after` is a (timestamp, id) keyset position.
+        '''
+        conditions = []
+        params = []
+        if self.user_ids is not None:
+            conditions.append("user_id = ANY(%s)")
+            params.append(self.user_ids)
+        if self.group_id is not None:
+            # An array rather than a subquery, so it is an index condition like the user set
+            conditions.append("user_id = ANY(ARRAY(SELECT user_id FROM group_members WHERE group_id = %s AND role = 'student'))")
+            params.append(self.group_id)
+        if self.log_types is not None:
+            conditions.append("type = ANY(%s)")
+            params.append(self.log_types)
+        if self.start is not None:
+            conditions.append("timestamp >= %s")
+            params.append(self.start)
+        if self.end is not None:
+            conditions.append("timestamp < %s")
+            params.append(self.end)
+        if after is not None:
+            comparison = "<" if sort == 'desc' else ">"
+            # The plain timestamp bound lets the planner prune partitions, which it can't do from the row comparison
+            conditions.append(f"timestamp {comparison}= %s AND (timestamp, id) {comparison} (%s, %s)")
+            params.extend([after[0], after[0], after[1]])
+        return (f"WHERE {' AND '.join(conditions)}" if conditions else ""), params
+
+    def select(self, columns="*", sort='asc', limit=None, after=None):
+        '''
+        The full SELECT and its parameters, ordered by (timestamp, id).
+        '''
+        direction = "DESC" if sort == 'desc' else "ASC"
+        where, params = self.where(sort, after)
+        query = f"SELECT {columns} FROM log {where} ORDER BY timestamp {direction}, id {direction}"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+        logger.debug("Log query planned on %s: %s", self.index, query)
+        return query, params
@@ -0,0 +1,112 @@
+# Group Membership
+#
+# Overview:
+# - One group_members row per (group, user), with the user's role in the group ('student' or 'staff')
+# - Indexed both ways: members of a group by the primary key, groups of a user by group_members_user_id_idx
+# - API responses keep the old array shape (users.groups, groups.staff, groups.students) via the expressions below
+# - Every membership change bumps updated on the users and groups involved, so their versions (ETags) move
+
+# Array-valued replacements for the old columns, for use in SELECTs on users / groups
+USER_GROUPS = "ARRAY(SELECT group_id FROM group_members WHERE user_id = users.id ORDER BY group_id)"
+GROUP_STAFF = "ARRAY(SELECT user_id FROM group_members WHERE group_id = groups.id AND role = 'staff' ORDER BY user_id)"
+GROUP_STUDENTS = "ARRAY(SELECT user_id FROM group_members WHERE group_id = groups.id AND role = 'student' ORDER BY user_id)"
+
+# A user's role in their groups follows from their user type
+ROLE = "CASE WHEN users.type = 'student' THEN 'student' ELSE 'staff' END"
+
+def touch(cursor, group_ids, user_ids):
+    '''
+    Bump updated on groups and users whose membership changed.
+    '''
+    if group_ids:
+        cursor.execute("UPDATE groups SET updated = NOW() WHERE id = ANY(%s)", (sorted(set(group_ids)),))
+    if user_ids:
+        cursor.execute("UPDATE users SET updated = NOW() WHERE id = ANY(%s)", (sorted(set(user_ids)),))
+
+def add_members(cursor, group_id, user_ids):
+    '''
+    Add users to a group, each with the role for their user type. Users already in the group
+    (or that don't exist) are skipped. Returns the ids of the users added.
+    '''
+    cursor.execute(
+        f"INSERT INTO group_members (group_id, user_id, role) SELECT %s, id, {ROLE} FROM users WHERE id = ANY(%s) "
+        "ON CONFLICT DO NOTHING RETURNING user_id",
+        (group_id, list(user_ids))
+    )
+    added = [row[0] for row in cursor.fetchall()]
+    if added:
+        touch(cursor, [group_id], added)
+    return added
+
+def remove_members(cursor, group_id, user_ids):
+    '''
+    Remove users from a group. Returns the ids of the users removed.
+    '''
+    cursor.execute("DELETE FROM group_members WHERE group_id = %s AND user_id = ANY(%s) RETURNING user_id", (group_id, list(user_ids)))
+    removed = [row[0] for row in cursor.fetchall()]
+    if removed:
+        touch(cursor, [group_id], removed)
+    return removed
+
+def set_user_groups(cursor, user_id, group_ids):
+    '''
+    Make `group_ids` the user's exact set of groups. Groups that don't exist are skipped.
+    Returns the ids of the groups joined and left.
+    '''
+    cursor.execute("DELETE FROM group_members WHERE user_id = %s AND group_id <> ALL(%s) RETURNING group_id", (user_id, list(group_ids)))
+    left = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        f"INSERT INTO group_members (group_id, user_id, role) SELECT groups.id, users.id, {ROLE} FROM groups, users "
+        "WHERE groups.id = ANY(%s) AND users.id = %s ON CONFLICT DO NOTHING RETURNING group_id",
+        (list(group_ids), user_id)
+    )
+    joined = [row[0] for row in cursor.fetchall()]
+    if joined or left:
+        touch(cursor, joined + left, [user_id])
+    return joined, left
+
+def sync_roles(cursor, user_ids):
+    '''
+    Bring the users' roles in their existing groups in line with their user type, e.g. after the type changed.
+    Returns the ids of the groups whose members' roles changed.
+    '''
+    cursor.execute(
+        f"UPDATE group_members SET role = {ROLE} FROM users WHERE users.id = group_members.user_id "
+        f"AND users.id = ANY(%s) AND group_members.role <> {ROLE} RETURNING group_members.group_id, group_members.user_id",
+        (list(user_ids),)
+    )
+    changed = cursor.fetchall()
+    if changed:
+        touch(cursor, [group_id for group_id, _ in changed], [user_id for _, user_id in changed])
+    return sorted({group_id for group_id, _ in changed})
+
+def set_memberships(cursor, memberships):
+    '''
+    Make each user's set of groups exactly as given, for many users at once: `memberships` maps
+    user id -> group ids. Roles are brought in line with each user's type. Groups and users that
+    don't exist are skipped. Returns the ids of the groups and users whose membership changed.
+    '''
+    if not memberships:
+        return set(), set()
+    user_ids = list(memberships)
+    pairs = [(user_id, group_id) for user_id, group_ids in memberships.items() for group_id in set(group_ids)]
+    member_users = [user_id for user_id, _ in pairs]
+    member_groups = [group_id for _, group_id in pairs]
+    cursor.execute(
+        "DELETE FROM group_members WHERE user_id = ANY(%s) AND (user_id, group_id) NOT IN (SELECT * FROM unnest(%s::integer[], %s::integer[])) RETURNING group_id, user_id",
+        (user_ids, member_users, member_groups)
+    )
+    changed = cursor.fetchall()
+    cursor.execute(
+        f"INSERT INTO group_members (group_id, user_id, role) SELECT groups.id, users.id, {ROLE} "
+        "FROM unnest(%s::integer[], %s::integer[]) AS member(user_id, group_id) "
+        "JOIN users ON users.id = member.user_id JOIN groups ON groups.id = member.group_id "
+        "ON CONFLICT (group_id, user_id) DO UPDATE SET role = EXCLUDED.role WHERE group_members.role <> EXCLUDED.role "
+        "RETURNING group_id, user_id",
+        (member_users, member_groups)
+    )
+    changed += cursor.fetchall()
+    group_ids = {group_id for group_id, _ in changed}
+    changed_users = {user_id for _, user_id in changed}
+    touch(cursor, group_ids, changed_users)
+    return group_ids, changed_users
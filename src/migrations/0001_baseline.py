@@ -0,0 +1,12 @@
+# Baseline schema
+#
+# Creates every table and index declared in database_schema.json. Safe to run against a
+# database that predates migrations, as all statements are IF NOT EXISTS.
+# database_schema.json is frozen at this version: later migrations change the schema from
+# this starting point, so the file must not be edited to match them.
+
+version = 1
+description = "Baseline schema from database_schema.json"
+
+def upgrade(db, cursor):
+    db.database_table_constructor(cursor)
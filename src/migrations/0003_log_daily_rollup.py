@@ -0,0 +1,39 @@
+# Daily log rollups
+#
+# Adds log_daily_rollup, one row per user per day with the log count and the
+# sum/count/min/max of every numeric metric, and backfills it from existing logs.
+
+version = 3
+description = "Per-user daily log rollups"
+
+METRICS = [
+    'daily_muscle_soreness',
+    'daily_stress_level',
+    'sleep_quality',
+    'sleep_duration_minutes',
+    'activity_duration_minutes',
+    'activity_RPE',
+    'study_duration_minutes'
+]
+
+def upgrade(db, cursor):
+    columns = ", ".join(
+        f"{metric}_sum bigint, {metric}_count integer NOT NULL DEFAULT 0, {metric}_min integer, {metric}_max integer"
+        for metric in METRICS
+    )
+    cursor.execute(f'''CREATE TABLE log_daily_rollup (
+        user_id integer references users(id) NOT NULL,
+        day date NOT NULL,
+        logs integer NOT NULL DEFAULT 0,
+        {columns},
+        updated timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, day)
+    )''')
+    cursor.execute("CREATE INDEX log_daily_rollup_day_idx ON log_daily_rollup (day)")
+
+    aggregates = ", ".join(f"SUM({metric}), COUNT({metric}), MIN({metric}), MAX({metric})" for metric in METRICS)
+    rollup_columns = ", ".join(f"{metric}_sum, {metric}_count, {metric}_min, {metric}_max" for metric in METRICS)
+    cursor.execute(f'''INSERT INTO log_daily_rollup (user_id, day, logs, {rollup_columns})
+        SELECT user_id, timestamp::date, COUNT(*), {aggregates}
+        FROM log
+        GROUP BY user_id, timestamp::date''')
@@ -0,0 +1,15 @@
+# Stats snapshots
+#
+# Adds stats_snapshots, which holds precomputed stats payloads (e.g. org-wide stats)
+# written by the task server and served as-is by the web server.
+
+version = 4
+description = "Precomputed stats snapshots"
+
+def upgrade(db, cursor):
+    cursor.execute('''CREATE TABLE stats_snapshots (
+        scope text PRIMARY KEY,
+        etag text NOT NULL,
+        generated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        payload jsonb NOT NULL
+    )''')
@@ -0,0 +1,46 @@
+# Streaks
+#
+# Adds streaks, one row per user holding their current and longest run of consecutive days
+# with a daily log, and streak_freezes, which pause streaks for a user, a group or the whole org.
+# Existing streaks are backfilled from the daily logs already recorded.
+
+version = 5
+description = "Streaks and streak freezes"
+
+def upgrade(db, cursor):
+    cursor.execute('''CREATE TABLE streaks (
+        user_id integer PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+        current_length integer NOT NULL DEFAULT 0,
+        longest_length integer NOT NULL DEFAULT 0,
+        last_logged_date date,
+        updated timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )''')
+    cursor.execute('''CREATE TABLE streak_freezes (
+        id serial PRIMARY KEY,
+        scope text NOT NULL CHECK (scope IN ('user', 'group', 'org')),
+        target_id integer,
+        starts date NOT NULL DEFAULT CURRENT_DATE,
+        ends date,
+        created_by integer,
+        created_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        CHECK ((scope = 'org') = (target_id IS NULL))
+    )''')
+    cursor.execute("CREATE INDEX streak_freezes_scope_target_idx ON streak_freezes (scope, target_id)")
+
+    # Gaps and islands: consecutive days share the same (day - row number), so each group is one run
+    cursor.execute('''
+        WITH days AS (
+            SELECT DISTINCT user_id, timestamp::date AS day FROM log WHERE type = 'daily'
+        ), runs AS (
+            SELECT user_id, MAX(day) AS last_day, COUNT(*) AS length
+            FROM (SELECT user_id, day, day - (ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY day))::integer AS run FROM days) numbered
+            GROUP BY user_id, run
+        )
+        INSERT INTO streaks (user_id, current_length, longest_length, last_logged_date)
+        SELECT user_id,
+            COALESCE(MAX(length) FILTER (WHERE last_day >= CURRENT_DATE - 1), 0),
+            MAX(length),
+            MAX(last_day)
+        FROM runs
+        GROUP BY user_id
+    ''')
@@ -0,0 +1,11 @@
+# Updated columns
+#
+# Adds an updated timestamp to users and groups, bumped by every write to the row.
+# Read endpoints derive their ETags from it.
+
+version = 6
+description = "Updated timestamps on users and groups"
+
+def upgrade(db, cursor):
+    cursor.execute("ALTER TABLE users ADD COLUMN updated timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP")
+    cursor.execute("ALTER TABLE groups ADD COLUMN updated timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP")
@@ -0,0 +1,15 @@
+# Log keyset indexes
+#
+# Log listings page on (timestamp, id), so the timestamp indexes gain id as a tiebreaker and
+# user listings get their own (user_id, timestamp, id) index. Each matches one of the
+# ORDER BY timestamp, id scans filter_log runs, so a page reads only the rows it returns.
+
+version = 7
+description = "Keyset pagination indexes on log"
+
+def upgrade(db, cursor):
+    cursor.execute("CREATE INDEX log_timestamp_id_idx ON log (timestamp, id)")
+    cursor.execute("CREATE INDEX log_type_timestamp_id_idx ON log (type, timestamp, id)")
+    cursor.execute("CREATE INDEX log_user_id_timestamp_id_idx ON log (user_id, timestamp, id)")
+    cursor.execute("DROP INDEX log_timestamp_idx")
+    cursor.execute("DROP INDEX log_type_timestamp_idx")
@@ -0,0 +1,43 @@
+# Group members
+#
+# Moves group membership out of the users.groups and groups.staff/students arrays into group_members,
+# one row per (group, user) with the user's role. Memberships recorded on either side are kept;
+# ids that no longer point at a user or group are dropped.
+
+version = 8
+description = "Group membership table replacing membership arrays"
+
+def upgrade(db, cursor):
+    cursor.execute('''CREATE TABLE group_members (
+        group_id integer NOT NULL REFERENCES groups(id) ON DELETE CASCADE,
+        user_id integer NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        role text NOT NULL CHECK (role IN ('student', 'staff')),
+        joined_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (group_id, user_id)
+    )''')
+    cursor.execute("CREATE INDEX group_members_user_id_idx ON group_members (user_id, group_id)")
+
+    # The group's arrays say which role a member has; memberships only on the user's side take it from their type
+    cursor.execute('''
+        INSERT INTO group_members (group_id, user_id, role)
+        SELECT groups.id, users.id, member.role
+        FROM groups
+        CROSS JOIN LATERAL (
+            SELECT unnest(groups.students) AS user_id, 'student' AS role
+            UNION ALL
+            SELECT unnest(groups.staff), 'staff'
+        ) member
+        JOIN users ON users.id = member.user_id
+        ON CONFLICT DO NOTHING
+    ''')
+    cursor.execute('''
+        INSERT INTO group_members (group_id, user_id, role)
+        SELECT groups.id, users.id, CASE WHEN users.type = 'student' THEN 'student' ELSE 'staff' END
+        FROM users
+        CROSS JOIN LATERAL unnest(users.groups) AS member(group_id)
+        JOIN groups ON groups.id = member.group_id
+        ON CONFLICT DO NOTHING
+    ''')
+
+    cursor.execute("ALTER TABLE users DROP COLUMN groups")
+    cursor.execute("ALTER TABLE groups DROP COLUMN staff, DROP COLUMN students")
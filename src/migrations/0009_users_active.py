@@ -0,0 +1,10 @@
+# Active users
+#
+# Adds users.active. Roster syncs deactivate users that have left the roster instead of deleting them,
+# so their logs and history stay; inactive users can't sign in.
+
+version = 9
+description = "Active flag on users"
+
+def upgrade(db, cursor):
+    cursor.execute("ALTER TABLE users ADD COLUMN active boolean NOT NULL DEFAULT TRUE")
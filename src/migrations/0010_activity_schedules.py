@@ -0,0 +1,12 @@
+# Activity schedules
+#
+# Links activites rows to the schedule that generated them. The unique (schedule_id, start_time) index
+# lets schedule materialization insert occurrences idempotently with ON CONFLICT DO NOTHING;
+# one-off activities have no schedule_id and are unaffected.
+
+version = 10
+description = "Schedule link and occurrence uniqueness on activites"
+
+def upgrade(db, cursor):
+    cursor.execute("ALTER TABLE activites ADD COLUMN schedule_id integer REFERENCES schedules(id) ON DELETE CASCADE")
+    cursor.execute("CREATE UNIQUE INDEX activites_schedule_id_start_time_idx ON activites (schedule_id, start_time)")
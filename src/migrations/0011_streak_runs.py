@@ -0,0 +1,25 @@
+# Streak runs
+#
+# Adds streaks.run_length, the length of the run of days ending at last_logged_date. Unlike
+# current_length it is not zeroed when a streak lapses, so a late log for the missing day
+# (e.g. a batch replayed after the nightly sweep) can continue the run instead of restarting it.
+# Backfilled from the daily logs already recorded.
+
+version = 11
+description = "Run length on streaks"
+
+def upgrade(db, cursor):
+    cursor.execute("ALTER TABLE streaks ADD COLUMN run_length integer NOT NULL DEFAULT 0")
+    cursor.execute("UPDATE streaks SET run_length = current_length")
+    cursor.execute('''
+        WITH days AS (
+            SELECT DISTINCT user_id, timestamp::date AS day FROM log WHERE type = 'daily'
+        ), runs AS (
+            SELECT user_id, MAX(day) AS last_day, COUNT(*) AS length
+            FROM (SELECT user_id, day, day - (ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY day))::integer AS run FROM days) numbered
+            GROUP BY user_id, run
+        )
+        UPDATE streaks SET run_length = GREATEST(streaks.current_length, runs.length)
+        FROM runs
+        WHERE runs.user_id = streaks.user_id AND runs.last_day = streaks.last_logged_date
+    ''')
@@ -0,0 +1,22 @@
+# Migrations
+#
+# Versioned schema migrations, applied in order by Database.migrate().
+# Each module defines:
+# - version: unique, increasing integer
+# - description: short summary, recorded in schema_migrations
+# - upgrade(db, cursor): applies the change
+# - transactional (optional, default True): set to False for statements that cannot run
+#   inside a transaction block, e.g. CREATE INDEX CONCURRENTLY
+modules = [
+    '0001_baseline',
+    '0002_partition_log',
+    '0003_log_daily_rollup',
+    '0004_stats_snapshots',
+    '0005_streaks',
+    '0006_updated_columns',
+    '0007_log_keyset_indexes',
+    '0008_group_members',
+    '0009_users_active',
+    '0010_activity_schedules',
+    '0011_streak_runs'
+]
@@ -0,0 +1,143 @@
+# Password Hashing
+#
+# Overview:
+# - PBKDF2 password hashing and verification
+# - Runs in a bounded pool of worker processes, so a burst of logins can't pin the web server's CPU
+# - Back-pressure: once the pool's queue is full, new requests are turned away instead of waiting
+# - If a worker dies the pool is broken; it is replaced and the request that hit it is told to retry
+
+import hashlib, hmac, os
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+PBKDF2_ITERATIONS = 100000
+
+# Directly from https://stackoverflow.com/questions/9594125/salt-and-hash-a-password-in-python
+def hash_new_password(password: str) -> tuple[bytes, bytes]:
+    """
+    Hash the provided password with a randomly-generated salt and return the
+    salt and hash to store in the database.
+    """
+    salt = os.urandom(16)
+    pw_hash = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, PBKDF2_ITERATIONS)
+    return salt, pw_hash
+
+def is_correct_password(salt: bytes, pw_hash: bytes, password: str) -> bool:
+    """
+    Given a previously-stored salt and hash, and a password provided by a user
+    trying to log in, check whether the password is correct.
+    """
+    return hmac.compare_digest(
+        pw_hash,
+        hashlib.pbkdf2_hmac('sha256', password.encode(), salt, PBKDF2_ITERATIONS)
+    )
+
+def _warm_up():
+    return os.getpid()
+
+class HasherBusy(Exception):
+    pass
+
+class HasherUnavailable(Exception):
+    pass
+
+class PasswordHasher:
+    '''
+    Runs hash_new_password/is_correct_password in a pool of `workers` processes.
+
+    At most `max_pending` hashes may be queued or running at once; beyond that (or if a hash
+    takes longer than `timeout` seconds) HasherBusy is raised so the caller can answer 429.
+    If the pool breaks (a worker died) it is replaced and HasherUnavailable is raised, so the caller can answer 503.
+    With workers=0 hashing runs in the calling thread, still bounded by max_pending.
+    '''
+    def __init__(self, workers=2, max_pending=8, timeout=5):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._rejected = 0
+        self._executor = None
+        self._restarts = 0
+        if workers > 0:
+            self._executor = self._start()
+            # Start every worker now, before the server starts its request threads
+            for future in [self._executor.submit(_warm_up) for _ in range(workers)]:
+                future.result()
+
+    def _start(self):
+        # Fork rather than spawn: spawned workers would re-run the web server's startup code
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+
+    def _replace(self, broken):
+        '''
+        Swap a broken executor for a new one, unless another thread already has.
+        '''
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self._executor = self._start()
+            self._restarts += 1
+        logger.error("Password hashing pool broke, started a new one")
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, _=None):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise HasherBusy("Password hashing queue is full")
+        with self._lock:
+            self._pending += 1
+        executor = self._executor
+        if executor is None:
+            try: return function(*args)
+            finally: self._release()
+        try: future = executor.submit(function, *args)
+        except BrokenProcessPool:
+            self._release()
+            self._replace(executor)
+            raise HasherUnavailable("Password hashing pool is restarting")
+        except Exception:
+            self._release()
+            raise
+        # The slot is held until the work actually finishes, even if the caller stops waiting
+        future.add_done_callback(self._release)
+        try: return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self._rejected += 1
+            raise HasherBusy("Password hashing timed out")
+        except BrokenProcessPool:
+            self._replace(executor)
+            raise HasherUnavailable("Password hashing pool is restarting")
+
+    def hash(self, password: str) -> tuple[bytes, bytes]:
+        return self._run(hash_new_password, password)
+
+    def verify(self, salt: bytes, pw_hash: bytes, password: str) -> bool:
+        return self._run(is_correct_password, salt, pw_hash, password)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self._pending,
+                "rejected": self._rejected,
+                "restarts": self._restarts
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
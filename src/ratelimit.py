@@ -0,0 +1,102 @@
+# Rate Limiting
+#
+# Overview:
+# - Token buckets keyed by route group and subject (user id, IP address or username)
+# - Stored in Redis and updated atomically by a Lua script, so every web server process shares them
+# - Falls back to in-process buckets while Redis is not configured or unreachable
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Refill the bucket for the time elapsed since it was last touched, then take `cost` tokens if there are enough.
+# Uses the Redis server's clock so buckets are consistent across web servers. Returns {allowed, retry_after}.
+TOKEN_BUCKET_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local last = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(retry_after)}
+'''
+
+# How long to stay on the in-process buckets after Redis fails, before trying it again
+REDIS_RETRY_SECONDS = 30
+
+def parse_limit(limit: str) -> tuple[int, float]:
+    '''
+    Parse a "capacity/seconds" limit, e.g. "10/60" allows bursts of 10 and refills 10 tokens a minute.
+    Returns (capacity, tokens per second).
+    '''
+    capacity, seconds = limit.split("/")
+    return int(capacity), int(capacity) / float(seconds)
+
+class RateLimiter:
+    '''
+    Token-bucket rate limiter. `limits` maps a route group to its (capacity, tokens per second).
+    '''
+    def __init__(self, limits, redis_url=None, max_local_buckets=100000):
+        self.limits = limits
+        self.max_local_buckets = max_local_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._redis = None
+        self._script = None
+        self._redis_down_until = 0
+        if redis_url and redis_url.startswith(("redis://", "rediss://", "unix://")):
+            import redis
+            self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.5)
+            self._script = self._redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def hit(self, group, subject, cost=1):
+        '''
+        Take `cost` tokens from the bucket for (group, subject).
+        Returns (allowed, seconds until the request would be allowed).
+        '''
+        capacity, rate = self.limits[group]
+        # A request can never cost more than a full bucket, or it could never be allowed
+        cost = min(cost, capacity)
+        key = f"ratelimit:{group}:{subject}"
+        if self._redis is not None and time.monotonic() >= self._redis_down_until:
+            try:
+                allowed, retry_after = self._script(keys=[key], args=[capacity, rate, cost])
+                return bool(allowed), float(retry_after)
+            except Exception as e:
+                logger.error("Rate limiter could not reach Redis, using in-process buckets for %ss: %s", REDIS_RETRY_SECONDS, e)
+                self._redis_down_until = time.monotonic() + REDIS_RETRY_SECONDS
+        return self._hit_local(key, capacity, rate, cost)
+
+    def _hit_local(self, key, capacity, rate, cost):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last, _, _ = self._buckets.get(key, (capacity, now, capacity, rate))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            if len(self._buckets) >= self.max_local_buckets and key not in self._buckets:
+                self._prune(now)
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now, capacity, rate)
+                return True, 0.0
+            self._buckets[key] = (tokens, now, capacity, rate)
+            return False, (cost - tokens) / rate
+
+    def _prune(self, now):
+        # Buckets that have refilled completely are the same as missing ones
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[0] + (now - bucket[1]) * bucket[3] < bucket[2]}
+        if len(self._buckets) >= self.max_local_buckets:
+            self._buckets.clear()
@@ -1,18 +1,96 @@
-from flask import jsonify, make_response
+from flask import current_app, request
+import datetime as dt
+import hashlib
+from decimal import Decimal
+
+def _default(value):
+    # Types neither encoder handles natively
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if hasattr(value, "tolist"): # NumPy scalars and arrays
+        return value.tolist()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+try:
+    import orjson
+
+    def dumps(value) -> bytes:
+        '''
+        Encode a value as compact JSON bytes. Dates and datetimes become ISO 8601 strings, tuples become arrays.
+        '''
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+except ImportError:
+    import json
+
+    def _stdlib_default(value):
+        if isinstance(value, (dt.datetime, dt.date, dt.time)):
+            return value.isoformat()
+        return _default(value)
+
+    def dumps(value) -> bytes:
+        '''
+        Encode a value as compact JSON bytes. Dates and datetimes become ISO 8601 strings, tuples become arrays.
+        '''
+        return json.dumps(value, default=_stdlib_default, separators=(",", ":")).encode()
+
+def version_etag(*parts) -> str:
+    '''
+    Strong ETag for one version of a resource, from values that change whenever it does
+    (e.g. its id and updated timestamp, row counts, and any request parameters that shape the body).
+    '''
+    return hashlib.sha256("|".join(map(str, parts)).encode()).hexdigest()[:32]
 
 class Response:
+    # Encoder for every response body, any function of value -> JSON bytes
+    dumps = staticmethod(dumps)
+
     def __init__(self, status_code, response_message, data=None):
         self.status_code = status_code
         self.response_message = response_message
         self.data = data or {}
-        
-        self.flask = make_response(jsonify(self.to_dict()), self.status_code)
-    
+        self.headers = {}
+        self.body = None
+        self.etag = None
+        self._flask = None
+
+    @classmethod
+    def from_json(cls, body, *args, **kwargs):
+        '''
+        Create a response whose data includes an already-serialized JSON object (str or bytes),
+        e.g. a payload stored as JSON, so it is sent without being decoded and encoded again.
+        Raises ValueError if the body isn't an object.
+        '''
+        response = cls(*args, **kwargs)
+        body = (body.encode() if isinstance(body, str) else body).strip()
+        if not (body.startswith(b"{") and body.endswith(b"}")):
+            raise ValueError("Pre-serialized response body must be a JSON object")
+        response.body = body
+        return response
+
+    def with_etag(self, etag):
+        self.etag = etag
+        return self
+
     def to_dict(self):
         return {"response": self.response_message} | self.data
-    
+
+    def to_json(self) -> bytes:
+        encoded = self.dumps(self.to_dict())
+        if self.body is None or self.body[1:].lstrip().startswith(b"}"):
+            return encoded
+        # Splice the pre-serialized object's members in after our own
+        return encoded[:-1] + b"," + self.body[1:]
+
     def build(self):
-        return self.flask
+        if self._flask is None:
+            self._flask = current_app.response_class(self.to_json(), status=self.status_code, mimetype="application/json", headers=self.headers)
+            if self.etag is not None:
+                self._flask.set_etag(self.etag)
+        return self._flask
 
 
 # Responses
@@ -43,6 +121,10 @@ class Responses:
             data.update({"new_url": new_url})
             super().__init__(302, "found", data)
 
+    class Not_Modified_304(Response):
+        def __init__(self, data=None):
+            super().__init__(304, "not_modified", data)
+
     class Temporary_Redirect_307(Response):
         def __init__(self, new_url="/", data=None):
             data = data or {}
@@ -87,8 +169,12 @@ class Responses:
             super().__init__(418, "im_a_teapot", data)
 
     class Too_Many_Requests_429(Response):
-        def __init__(self, data=None):
+        def __init__(self, details="Too many requests, try again later.", retry_after=None, data=None):
+            data = data or {}
+            data.update({"details": details})
             super().__init__(429, "too_many_requests", data)
+            if retry_after is not None:
+                self.headers["Retry-After"] = str(retry_after)
 
     class Unavailable_For_Legal_Reasons_451(Response): # gotta catch em all.
         def __init__(self, details="The requested resource is unavailable due to legal reasons.", data=None):
@@ -102,6 +188,14 @@ class Responses:
             data = data or {}
             data.update({"details": details})
             super().__init__(500, "internal_server_error", data)
+
+    class Service_Unavailable_503(Response):
+        def __init__(self, details="The service is temporarily unavailable. Try again later.", retry_after=None, data=None):
+            data = data or {}
+            data.update({"details": details})
+            super().__init__(503, "service_unavailable", data)
+            if retry_after is not None:
+                self.headers["Retry-After"] = str(retry_after)
     
     resps = {
         200: OK_200,
@@ -109,6 +203,7 @@ class Responses:
         202: Accepted_202,
         301: Moved_Permanently_301,
         302: Found_302,
+        304: Not_Modified_304,
         307: Temporary_Redirect_307,
         308: Permanent_Redirect_308,
         400: Bad_Request_400,
@@ -118,9 +213,18 @@ class Responses:
         418: Im_A_Teapot_418,
         429: Too_Many_Requests_429,
         451: Unavailable_For_Legal_Reasons_451,
-        500: Internal_Server_Error_500
+        500: Internal_Server_Error_500,
+        503: Service_Unavailable_503
     }
     
+    def not_modified(etag: str):
+        '''
+        A 304 response if the request's If-None-Match already has this ETag, otherwise None.
+        '''
+        if etag in request.if_none_match:
+            return Responses.Not_Modified_304().with_etag(etag)
+        return None
+
     def get(code: int, *args):
         try:   
             return Responses.resps[code](*args)
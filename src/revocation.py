@@ -0,0 +1,196 @@
+# Token Revocation
+#
+# Overview:
+# - Revoked token ids (jti), sessions (sid) and users ("sign out everywhere"), kept in Redis
+#   until every token they could match has expired
+# - Mirrored into an in-process Bloom filter, so checking a token that isn't revoked never leaves the process
+# - Other processes hear about revocations over Redis pub/sub, with a periodic full resync as a backstop
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "revoked:"
+CHANNEL = "revocations"
+# Seconds the listener waits for a message before checking in (and health-checking the connection) again
+LISTEN_TIMEOUT = 30
+
+class RevocationUnavailable(Exception):
+    pass
+
+class BloomFilter:
+    '''
+    Fixed-size Bloom filter over strings. May report false positives, never false negatives.
+    '''
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+class RevocationList:
+    '''
+    Revocation entries are "jti:<id>", "sid:<id>" or "user:<id>", each stored with the time it was revoked.
+    A token is revoked if its jti or sid is listed, or its user was revoked at or after the token was issued.
+
+    Without a redis_url entries are kept in-process, which only suits a single web server process.
+    If Redis can't confirm a possible match the token is treated as revoked.
+    '''
+    def __init__(self, redis_url=None, capacity=100000, error_rate=0.001, sync_interval=60):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._added_since_sync = []
+        self._local = {}
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url and redis_url.startswith(("redis://", "rediss://", "unix://")):
+            import redis
+            self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.5)
+            # Pub/sub sits idle until something is revoked, so it gets its own connection without the short
+            # timeout used for lookups; periodic health checks notice if it has gone away instead
+            self._pubsub_redis = redis.Redis.from_url(redis_url, socket_timeout=None, socket_keepalive=True, health_check_interval=LISTEN_TIMEOUT)
+            threading.Thread(target=self._listen, name="revocation-listener", daemon=True).start()
+            threading.Thread(target=self._sync_forever, name="revocation-sync", daemon=True).start()
+
+    def revoke(self, entry, ttl):
+        '''
+        Revoke a "jti:...", "sid:..." or "user:..." entry for `ttl` seconds (the longest any matching token can live).
+        Raises RevocationUnavailable if it can't be stored in Redis, as other processes would still accept the token.
+        '''
+        ttl = max(1, math.ceil(ttl))
+        with self._lock:
+            self._add(entry)
+            if self._redis is None:
+                now = time.time()
+                if len(self._local) >= self.capacity:
+                    self._local = {key: value for key, value in self._local.items() if value[0] > now}
+                self._local[entry] = (now + ttl, now)
+        if self._redis is not None:
+            try:
+                pipeline = self._redis.pipeline()
+                pipeline.set(KEY_PREFIX + entry, time.time(), ex=ttl)
+                pipeline.publish(CHANNEL, entry)
+                pipeline.execute()
+            except Exception as e:
+                logger.error("Could not store revocation of %s: %s", entry, e)
+                raise RevocationUnavailable(f"Could not store revocation: {e}") from e
+        logger.info("Revoked %s for %ss", entry, ttl)
+
+    def claim(self, entry, ttl):
+        '''
+        Revoke `entry` for `ttl` seconds only if it isn't revoked already, atomically, so of several
+        concurrent claims exactly one succeeds. Returns whether this call revoked it.
+        Raises RevocationUnavailable if Redis can't be reached.
+        '''
+        ttl = max(1, math.ceil(ttl))
+        if self._redis is None:
+            now = time.time()
+            with self._lock:
+                if entry in self._local and self._local[entry][0] > now:
+                    return False
+                self._add(entry)
+                self._local[entry] = (now + ttl, now)
+            return True
+        try:
+            if not self._redis.set(KEY_PREFIX + entry, time.time(), ex=ttl, nx=True):
+                return False
+            self._redis.publish(CHANNEL, entry)
+        except Exception as e:
+            logger.error("Could not claim %s: %s", entry, e)
+            raise RevocationUnavailable(f"Could not store revocation: {e}") from e
+        with self._lock:
+            self._add(entry)
+        return True
+
+    def is_revoked(self, claims):
+        '''
+        Check a decoded token's jti, sid and user against the list.
+        '''
+        entries = [f"jti:{claims.get('jti')}", f"sid:{claims.get('sid')}", f"user:{claims.get('user')}"]
+        candidates = [entry for entry in entries if entry in self._bloom]
+        if not candidates:
+            return False
+        try: revoked_at = self._lookup(candidates)
+        except Exception as e:
+            logger.error("Could not confirm token revocation, rejecting token: %s", e)
+            return True
+        for entry, value in zip(candidates, revoked_at):
+            if value is None:
+                continue
+            if not entry.startswith("user:") or float(value) >= claims.get("iat", 0):
+                return True
+        return False
+
+    def _lookup(self, entries):
+        if self._redis is not None:
+            return self._redis.mget([KEY_PREFIX + entry for entry in entries])
+        now = time.time()
+        with self._lock:
+            return [self._local[entry][1] if entry in self._local and self._local[entry][0] > now else None for entry in entries]
+
+    def _add(self, entry):
+        # Call with the lock held
+        self._bloom.add(entry)
+        if self._redis is not None:
+            self._added_since_sync.append(entry)
+
+    def _listen(self):
+        while True:
+            pubsub = self._pubsub_redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(CHANNEL)
+                # Anything revoked while we weren't subscribed is picked up by a fresh sync
+                self.sync()
+                while True:
+                    message = pubsub.get_message(timeout=LISTEN_TIMEOUT)
+                    if message is not None and message["type"] == "message":
+                        with self._lock:
+                            self._add(message["data"].decode())
+            except Exception as e:
+                logger.error("Revocation listener disconnected, retrying: %s", e)
+                time.sleep(5)
+            finally:
+                pubsub.close()
+
+    def _sync_forever(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try: self.sync()
+            except Exception as e: logger.error("Revocation sync failed: %s", e)
+
+    def sync(self):
+        '''
+        Rebuild the Bloom filter from the entries still in Redis, which also drops expired ones.
+        '''
+        with self._lock:
+            self._added_since_sync = []
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        count = 0
+        for key in self._redis.scan_iter(match=KEY_PREFIX + "*", count=1000):
+            bloom.add(key.decode()[len(KEY_PREFIX):])
+            count += 1
+        with self._lock:
+            # Keep anything revoked while the scan was running
+            for entry in self._added_since_sync:
+                bloom.add(entry)
+            self._added_since_sync = []
+            self._bloom = bloom
+        if count > self.capacity:
+            logger.warning("Revocation list holds %s entries, above its Bloom filter capacity of %s", count, self.capacity)
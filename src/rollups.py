@@ -0,0 +1,116 @@
+# Log Rollups
+#
+# Overview:
+# - Per-user, per-day summaries of the log table (log_daily_rollup)
+# - Kept up to date by the log endpoints in the same transaction as the write
+# - Weekly/monthly stats derived from the daily rows
+
+import datetime as dt
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Numeric log fields that stats are calculated for, and the log type that records them
+METRICS = {
+    'daily_muscle_soreness': 'daily',
+    'daily_stress_level': 'daily',
+    'sleep_quality': 'sleep',
+    'sleep_duration_minutes': 'sleep',
+    'activity_duration_minutes': 'activity',
+    'activity_RPE': 'activity',
+    'study_duration_minutes': 'study'
+}
+
+# Rollup columns kept for each metric, and the aggregate that fills them from raw logs
+AGGREGATES = {
+    'sum': 'SUM',
+    'count': 'COUNT',
+    'min': 'MIN',
+    'max': 'MAX'
+}
+
+ROLLUP_COLUMNS = [f"{metric}_{suffix}" for metric in METRICS for suffix in AGGREGATES]
+
+# First key of the per-user advisory lock (user id is the second) serialising rollup refreshes
+ROLLUP_LOCK_ID = 7261002
+
+REFRESH_QUERY = f'''
+WITH fresh AS (
+    SELECT user_id, timestamp::date AS day, COUNT(*) AS logs, {", ".join(f"{function}({metric})" for metric in METRICS for function in AGGREGATES.values())}
+    FROM log
+    WHERE user_id = %(user_id)s AND timestamp >= %(start)s AND timestamp < %(end)s AND timestamp::date = ANY(%(days)s)
+    GROUP BY user_id, timestamp::date
+), removed AS (
+    DELETE FROM log_daily_rollup
+    WHERE user_id = %(user_id)s AND day = ANY(%(days)s) AND day NOT IN (SELECT day FROM fresh)
+)
+INSERT INTO log_daily_rollup (user_id, day, logs, {", ".join(ROLLUP_COLUMNS)})
+SELECT * FROM fresh
+ON CONFLICT (user_id, day) DO UPDATE SET logs = EXCLUDED.logs, {", ".join(f"{column} = EXCLUDED.{column}" for column in ROLLUP_COLUMNS)}, updated = NOW()
+'''
+
+def refresh_daily_rollups(cursor, user_id, days):
+    '''
+    Recalculate a user's rollup rows for the given days from their logs.
+    Run it with the cursor that wrote the logs, so the rollups commit (or roll back) with the write.
+
+    Takes a lock on the user until the transaction ends: without it, two writes for the same day each
+    recount from a snapshot missing the other's log, and whichever upsert lands last loses a log.
+    The lock is taken in its own statement so the recount's snapshot includes writes committed while waiting.
+    '''
+    days = sorted(set(days))
+    if not days:
+        return
+    cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (ROLLUP_LOCK_ID, user_id))
+    cursor.execute(REFRESH_QUERY, {
+        "user_id": user_id,
+        "days": days,
+        "start": days[0],
+        "end": days[-1] + dt.timedelta(days=1)
+    })
+
+def rollup_version(db, user_ids, start: dt.date = None, end: dt.date = None):
+    '''
+    Cheap version stamp for users' rollups (optionally only the days in [start, end)).
+    Every log write refreshes the rollup for its day, so the stamp changes whenever any of their logs do.
+    '''
+    return db.execute_query_fetchone(
+        "SELECT MAX(updated), COUNT(*), SUM(logs) FROM log_daily_rollup WHERE user_id = ANY(%s) AND day >= COALESCE(%s, '-infinity'::date) AND day < COALESCE(%s, 'infinity'::date)",
+        (list(user_ids), start, end)
+    )
+
+def period_stats(db, user_id, start: dt.date, end: dt.date):
+    '''
+    Summarise a user's rollups for the days in [start, end).
+    Returns the totals for the period and a per-day breakdown.
+    '''
+    rows = db.execute_query_fetchall(
+        f"SELECT day, logs, {', '.join(ROLLUP_COLUMNS)} FROM log_daily_rollup WHERE user_id = %s AND day >= %s AND day < %s ORDER BY day",
+        (user_id, start, end)
+    )
+
+    stats = {
+        "user_id": user_id,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "logs": sum(row[1] for row in rows),
+        "days_logged": len(rows),
+        "days": []
+    }
+    for i, metric in enumerate(METRICS):
+        columns = [row[2 + i * 4:6 + i * 4] for row in rows]
+        total = sum(column[0] for column in columns if column[0] is not None)
+        count = sum(column[1] for column in columns)
+        stats[metric] = {
+            "average": total / count if count else None,
+            "min": min((column[2] for column in columns if column[2] is not None), default=None),
+            "max": max((column[3] for column in columns if column[3] is not None), default=None),
+            "count": count
+        }
+    for row in rows:
+        day = {"day": row[0].isoformat(), "logs": row[1]}
+        for i, metric in enumerate(METRICS):
+            total, count = row[2 + i * 4], row[3 + i * 4]
+            day[metric] = total / count if count else None
+        stats["days"].append(day)
+    return stats
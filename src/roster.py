@@ -0,0 +1,245 @@
+# Roster Sync
+#
+# Overview:
+# - Parse a school roster (CSV or JSON) into user records
+# - Diff it against the users table in memory, keyed by username, comparing a hash of each user's synced fields
+# - New users' passwords are hashed before the roster is queued (hash_passwords), so jobs never carry plaintext passwords
+# - Apply the inserts, updates and deactivations in batched transactions
+
+import csv, io, json
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values
+from passwords import hash_new_password
+from membership import USER_GROUPS, set_memberships
+
+logger = logging.getLogger(__name__)
+
+MAX_ROWS = 20000
+USER_TYPES = ['student', 'teacher', 'admin']
+# Fields compared between the roster and the users table; groups only when the roster gives them
+SYNCED_FIELDS = ['email', 'pname', 'fname', 'lname', 'type', 'active', 'groups']
+
+def parse_roster(data, format):
+    '''
+    Parse a roster into user records: username, email, fname, lname, pname, type, groups (list of
+    group names, or None to leave memberships alone) and password (only used for new users; see hash_passwords).
+    CSV rows give groups separated by ";". JSON is a list of objects, or {"users": [...]}.
+    Raises ValueError describing the first invalid row.
+    '''
+    if isinstance(data, bytes):
+        data = data.decode("utf-8-sig")
+    if format == 'csv':
+        rows = list(csv.DictReader(io.StringIO(data)))
+        for row in rows:
+            if row.get('groups') is not None:
+                row['groups'] = [name for name in row['groups'].split(";") if name.strip()] if row['groups'].strip() else []
+    elif format == 'json':
+        try: rows = json.loads(data)
+        except json.JSONDecodeError: raise ValueError("Roster is not valid JSON")
+        if isinstance(rows, dict):
+            rows = rows.get('users')
+        if not isinstance(rows, list):
+            raise ValueError("Roster must be a list of users")
+    else:
+        raise ValueError("Roster format must be 'csv' or 'json'")
+    if not rows:
+        raise ValueError("Roster is empty")
+    if len(rows) > MAX_ROWS:
+        raise ValueError(f"Roster has more than {MAX_ROWS} users")
+
+    records = []
+    usernames, emails = set(), set()
+    for number, row in enumerate(rows, start=1):
+        try: record = parse_record(row)
+        except ValueError as e: raise ValueError(f"Row {number}: {e}")
+        if record['username'] in usernames:
+            raise ValueError(f"Row {number}: duplicate username {record['username']}")
+        if record['email'] in emails:
+            raise ValueError(f"Row {number}: duplicate email {record['email']}")
+        usernames.add(record['username'])
+        emails.add(record['email'])
+        records.append(record)
+    return records
+
+def parse_record(row):
+    if not isinstance(row, dict):
+        raise ValueError("must be an object")
+    def text(field, default=None):
+        value = row.get(field)
+        if value is None or value == "":
+            if default is None:
+                raise ValueError(f"missing {field}")
+            return default
+        if not isinstance(value, str):
+            raise ValueError(f"invalid {field}")
+        return value.strip()
+
+    record = {
+        'username': text('username'),
+        'email': text('email'),
+        'fname': text('fname'),
+        'lname': text('lname'),
+        'type': text('type', 'student'),
+        'password': row.get('password') or None
+    }
+    record['pname'] = text('pname', record['fname'])
+    if not 3 <= len(record['username']) <= 20: raise ValueError("username must be between 3 and 20 characters")
+    if "@" not in record['email'] or len(record['email']) > 50: raise ValueError("invalid email address")
+    for field in ('fname', 'lname', 'pname'):
+        if not 1 <= len(record[field]) <= 30: raise ValueError(f"{field} must be between 1 and 30 characters")
+    if record['type'] not in USER_TYPES: raise ValueError("invalid user type")
+    if record['password'] is not None and (not isinstance(record['password'], str) or not 8 <= len(record['password']) <= 25):
+        raise ValueError("password must be between 8 and 25 characters")
+
+    groups = row.get('groups')
+    if groups is not None and (not isinstance(groups, list) or not all(isinstance(name, str) for name in groups)):
+        raise ValueError("groups must be a list of group names")
+    record['groups'] = sorted({name.strip() for name in groups}) if groups is not None else None
+    return record
+
+def hash_passwords(records, existing_usernames, workers=4):
+    '''
+    Replace each record's plaintext password with "password_hash", its (salt, hash) in hex. Only users not in
+    `existing_usernames` are hashed, since a sync only sets new users' passwords; the others' passwords are dropped.
+    '''
+    new = [record for record in records if record['password'] is not None and record['username'] not in existing_usernames]
+    # pbkdf2_hmac releases the GIL, so threads hash in parallel without needing child processes
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        hashes = dict(zip((record['username'] for record in new), pool.map(hash_new_password, [record['password'] for record in new])))
+    hashed = []
+    for record in records:
+        record = {field: value for field, value in record.items() if field != 'password'}
+        salt, pw_hash = hashes.get(record['username'], (None, None))
+        record['password_hash'] = [salt.hex(), pw_hash.hex()] if salt is not None else None
+        hashed.append(record)
+    return hashed
+
+def record_hash(record, with_groups):
+    '''
+    Hash of the synced fields of a roster record or users row, so each side of the diff is compared in one step.
+    '''
+    fields = [record[field] for field in SYNCED_FIELDS if field != 'groups' or with_groups]
+    return hashlib.sha256(json.dumps(fields).encode()).digest()
+
+def diff_roster(existing, records, deactivate_missing=True, protect=()):
+    '''
+    Compare roster records (with groups resolved to sorted ids) against `existing` users
+    (username -> row with id and the synced fields). Returns (inserts, updates, deactivations, errors):
+    the records to insert, (id, record) pairs to update, user ids to deactivate and per-user errors.
+
+    Only active users of a type that appears in the roster are deactivated, so a student roster
+    never touches staff accounts; users in `protect` are never deactivated.
+    '''
+    inserts, updates, errors = [], [], []
+    email_owners = {user['email']: username for username, user in existing.items()}
+    for record in records:
+        record = dict(record, active=True)
+        current = existing.get(record['username'])
+        if email_owners.get(record['email'], record['username']) != record['username']:
+            errors.append({"username": record['username'], "error": "Email is already used by another user"})
+            continue
+        if current is None:
+            if record['password_hash'] is None:
+                errors.append({"username": record['username'], "error": "New users need a password"})
+                continue
+            inserts.append(record)
+            continue
+        with_groups = record['groups'] is not None
+        if record_hash(record, with_groups) != record_hash(current, with_groups):
+            updates.append((current['id'], record))
+
+    deactivations = []
+    if deactivate_missing:
+        listed = {record['username'] for record in records}
+        types = {record['type'] for record in records}
+        deactivations = [
+            user['id'] for username, user in existing.items()
+            if username not in listed and user['active'] and user['type'] in types and user['id'] not in protect
+        ]
+    return inserts, updates, deactivations, errors
+
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def sync_roster(db, records, deactivate_missing=True, protect=(), dry_run=False, batch_size=500, progress=None):
+    '''
+    Bring the users table in line with a parsed roster whose passwords went through hash_passwords. Each batch is applied in its own transaction,
+    and `progress(done, total)` is called after each one.
+    Returns a summary, plus the ids of every user changed under "user_ids".
+    '''
+    columns = ['id', 'username'] + [field for field in SYNCED_FIELDS if field != 'groups']
+    rows = db.execute_query_fetchall(f"SELECT {', '.join(columns)}, {USER_GROUPS} FROM users")
+    existing = {row[1]: dict(zip(columns + ['groups'], row)) for row in rows}
+    group_ids = dict(db.execute_query_fetchall("SELECT name, id FROM groups"))
+
+    resolved = []
+    errors = []
+    for record in records:
+        if record['groups'] is not None:
+            unknown = [name for name in record['groups'] if name not in group_ids]
+            if unknown:
+                errors.append({"username": record['username'], "error": f"Unknown groups: {', '.join(unknown)}"})
+                continue
+            record = dict(record, groups=sorted(group_ids[name] for name in record['groups']))
+        resolved.append(record)
+
+    inserts, updates, deactivations, diff_errors = diff_roster(existing, resolved, deactivate_missing, set(protect))
+    errors += diff_errors
+    summary = {
+        "inserted": len(inserts),
+        "updated": len(updates),
+        "deactivated": len(deactivations),
+        "unchanged": len(resolved) - len(inserts) - len(updates) - len(diff_errors),
+        "errors": errors,
+        "dry_run": dry_run,
+        "user_ids": []
+    }
+    logger.info("Roster diff: %s to insert, %s to update, %s to deactivate, %s errors", len(inserts), len(updates), len(deactivations), len(errors))
+    if dry_run:
+        return summary
+
+    total = len(inserts) + len(updates) + len(deactivations)
+    done = 0
+    if progress: progress(done, total)
+    user_ids = summary["user_ids"]
+
+    for batch in batches(inserts, batch_size):
+        with db.transaction() as cursor:
+            inserted = execute_values(
+                cursor,
+                "INSERT INTO users (username, email, password_hash, password_salt, pname, fname, lname, type) VALUES %s RETURNING id, username",
+                [(record['username'], record['email'], record['password_hash'][1], record['password_hash'][0], record['pname'], record['fname'], record['lname'], record['type'])
+                 for record in batch],
+                page_size=len(batch),
+                fetch=True
+            )
+            ids = dict((username, user_id) for user_id, username in inserted)
+            set_memberships(cursor, {ids[record['username']]: record['groups'] for record in batch if record['groups']})
+        user_ids.extend(ids.values())
+        done += len(batch)
+        if progress: progress(done, total)
+
+    for batch in batches(updates, batch_size):
+        with db.transaction() as cursor:
+            execute_values(
+                cursor,
+                "UPDATE users SET email = v.email, pname = v.pname, fname = v.fname, lname = v.lname, type = v.type, active = TRUE, updated = NOW() "
+                "FROM (VALUES %s) AS v(id, email, pname, fname, lname, type) WHERE users.id = v.id",
+                [(user_id, record['email'], record['pname'], record['fname'], record['lname'], record['type']) for user_id, record in batch],
+                page_size=len(batch)
+            )
+            set_memberships(cursor, {user_id: record['groups'] for user_id, record in batch if record['groups'] is not None})
+        user_ids.extend(user_id for user_id, _ in batch)
+        done += len(batch)
+        if progress: progress(done, total)
+
+    for batch in batches(deactivations, batch_size):
+        with db.transaction() as cursor:
+            cursor.execute("UPDATE users SET active = FALSE, updated = NOW() WHERE id = ANY(%s)", (batch,))
+        user_ids.extend(batch)
+        done += len(batch)
+        if progress: progress(done, total)
+    return summary
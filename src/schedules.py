@@ -0,0 +1,177 @@
+# Schedules
+#
+# Overview:
+# - Cron expressions (minute hour day-of-month month day-of-week) compiled once into a matcher
+# - Occurrences generated lazily, a day at a time, so a window only costs the days it covers
+# - Upcoming occurrences materialized as activites rows ahead of time, idempotently (one row per schedule and start time)
+
+import datetime as dt
+import itertools
+import logging
+from functools import lru_cache
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+# Most occurrences one schedule may materialize per run, so a schedule like "* * * * *" can't flood activites
+MAX_OCCURRENCES = 1000
+
+MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *"
+}
+MONTH_NAMES = {name: number for number, name in enumerate(["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], start=1)}
+DAY_NAMES = {name: number for number, name in enumerate(["sun", "mon", "tue", "wed", "thu", "fri", "sat"])}
+# Longest each month can be (February in leap years)
+DAYS_IN_MONTH = {1: 31, 2: 29, 3: 31, 4: 30, 5: 31, 6: 30, 7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31}
+# (name, lowest, highest, names) for each field, in expression order
+FIELDS = [
+    ("minute", 0, 59, {}),
+    ("hour", 0, 23, {}),
+    ("day of month", 1, 31, {}),
+    ("month", 1, 12, MONTH_NAMES),
+    ("day of week", 0, 7, DAY_NAMES)
+]
+
+def parse_field(text, name, lowest, highest, names):
+    '''
+    Parse one cron field ("*", "5", "1-5", "*/15", "mon-fri", "1,15", ...) into the sorted values it allows.
+    '''
+    def value(part):
+        part = part.lower()
+        if part in names:
+            return names[part]
+        if not part.isdigit() or not lowest <= int(part) <= highest:
+            raise ValueError(f"Invalid {name}: {part}")
+        return int(part)
+
+    values = set()
+    for item in text.split(","):
+        item, _, step = item.partition("/")
+        if step and (not step.isdigit() or int(step) == 0):
+            raise ValueError(f"Invalid {name} step: {step}")
+        if item == "*":
+            start, end = lowest, highest
+        elif "-" in item:
+            start, end = (value(part) for part in item.split("-", 1))
+            # Sunday (0 or 7) ends a day of week range as 7, so "mon-sun" and "sat-sun" are valid
+            if name == "day of week" and end == 0:
+                end = 7
+            if start > end:
+                raise ValueError(f"Invalid {name} range: {item}")
+        else:
+            start = value(item)
+            # "5/15" means every 15 starting at 5
+            end = highest if step else start
+        values.update(range(start, end + 1, int(step or 1)))
+    return sorted(values)
+
+class CronSchedule:
+    '''
+    A compiled cron expression. Follows cron's rule that when both day of month and day of week
+    are restricted, a day matching either one matches; a field starting with "*" (e.g. "*/2") counts
+    as unrestricted for this, so it combines with the other one. Sunday is 0 or 7.
+    '''
+    def __init__(self, expression):
+        self.expression = expression
+        fields = MACROS.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError("Cron expression must have 5 fields: minute hour day-of-month month day-of-week")
+        minutes, hours, days, months, weekdays = (parse_field(text, *field) for text, field in zip(fields, FIELDS))
+        self.minutes = minutes
+        self.hours = hours
+        self.days = frozenset(days)
+        self.months = frozenset(months)
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        self.any_day = fields[2].startswith("*")
+        self.any_weekday = fields[4].startswith("*")
+        # Otherwise an open-ended search for the next occurrence of e.g. "0 0 30 2 *" would never end
+        if self.any_weekday and not any(day <= DAYS_IN_MONTH[month] for month in self.months for day in self.days):
+            raise ValueError("Cron expression never matches a real date")
+
+    def matches_day(self, day: dt.date):
+        if day.month not in self.months:
+            return False
+        in_days = day.day in self.days
+        # isoweekday: Monday 1 ... Sunday 7, so % 7 gives cron's Sunday 0
+        in_weekdays = day.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def matches(self, moment: dt.datetime):
+        return moment.minute in self.minutes and moment.hour in self.hours and self.matches_day(moment.date())
+
+    def occurrences(self, start: dt.datetime, end: dt.datetime = None):
+        '''
+        Yield matching times in [start, end), in order; without an end the generator never finishes.
+        Only matching days are expanded into times, so sparse schedules are cheap over long windows.
+        '''
+        start = start.replace(second=0, microsecond=0) + (dt.timedelta(minutes=1) if start.second or start.microsecond else dt.timedelta())
+        day = start.date()
+        while end is None or day <= end.date():
+            if self.matches_day(day):
+                for hour, minute in itertools.product(self.hours, self.minutes):
+                    moment = dt.datetime.combine(day, dt.time(hour, minute))
+                    if moment < start:
+                        continue
+                    if end is not None and moment >= end:
+                        return
+                    yield moment
+            day += dt.timedelta(days=1)
+
+@lru_cache(maxsize=1024)
+def compile_cron(expression) -> CronSchedule:
+    '''
+    Compile a cron expression, reusing the matcher for expressions seen before. Raises ValueError if it is invalid.
+    '''
+    return CronSchedule(expression)
+
+def materialize_schedules(db, horizon_days=14, now=None):
+    '''
+    Create the activites rows for every schedule's occurrences from now (or the schedule's default
+    start time, if that is later) until `horizon_days` ahead.
+    Each occurrence copies the schedule's defaults, lasting as long as its default start to end time.
+    Occurrences that already have a row are skipped, so this can run as often as needed.
+    New activity ids are also appended to the schedule's activities array.
+    Returns the number of rows created.
+    '''
+    now = now or dt.datetime.now()
+    end = now + dt.timedelta(days=horizon_days)
+    schedules = db.execute_query_fetchall('''
+        SELECT id, cron, owner, default_name, default_type, default_parent, default_description,
+            default_location, default_attachments, default_start_time, default_end_time
+        FROM schedules
+    ''')
+    created = 0
+    for schedule_id, cron, owner, name, activity_type, parent, description, location, attachments, default_start, default_end in schedules:
+        try: schedule = compile_cron(cron)
+        except ValueError as e:
+            logger.error("Schedule %s has an invalid cron expression %r: %s", schedule_id, cron, e)
+            continue
+        duration = default_end - default_start
+        rows = [
+            (schedule_id, name, activity_type, owner, parent, description, location, attachments, start, start + duration)
+            for start in itertools.islice(schedule.occurrences(max(now, default_start), end), MAX_OCCURRENCES)
+        ]
+        if not rows:
+            continue
+        with db.transaction() as cursor:
+            inserted = execute_values(
+                cursor,
+                "INSERT INTO activites (schedule_id, name, type, owner, parent, description, location, attachments, start_time, end_time) VALUES %s "
+                "ON CONFLICT (schedule_id, start_time) DO NOTHING RETURNING id",
+                rows,
+                page_size=len(rows),
+                fetch=True
+            )
+            if inserted:
+                cursor.execute("UPDATE schedules SET activities = activities || %s WHERE id = %s", ([row[0] for row in inserted], schedule_id))
+        created += len(inserted)
+    logger.info("Materialized %s activities from %s schedules up to %s", created, len(schedules), end)
+    return created
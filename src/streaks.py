@@ -0,0 +1,120 @@
+# Streaks
+#
+# Overview:
+# - Per-user streak state (current/longest/run length, last logged day), updated per daily log without rescanning logs
+# - Freezes for a user, a group or the whole org, each stored as a single row
+# - Each daily log extends the run when every day since the last one is covered by a freeze, or restarts it
+# - Nightly set-based sweep that zeroes every lapsed, unfrozen streak in one statement
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Only daily logs count towards a streak
+STREAK_LOG_TYPE = 'daily'
+
+# A freeze applies to a user when it targets them, one of their groups, or the whole org.
+# Expects the user's row aliased as "u" and the freeze as "f".
+FREEZE_APPLIES = "(f.scope = 'org' OR (f.scope = 'user' AND f.target_id = u.id) OR (f.scope = 'group' AND EXISTS (SELECT 1 FROM group_members m WHERE m.group_id = f.target_id AND m.user_id = u.id)))"
+
+def gap_frozen(after, before):
+    '''
+    SQL condition that every day strictly between the dates `after` and `before` is covered by a freeze
+    applying to user "u" (true when there are no days in between). Days with no log break a streak otherwise.
+    '''
+    return f'''NOT EXISTS (
+        SELECT 1 FROM generate_series({after} + 1, {before} - 1, interval '1 day') gap(day)
+        WHERE NOT EXISTS (SELECT 1 FROM streak_freezes f WHERE f.starts <= gap.day::date AND (f.ends IS NULL OR f.ends >= gap.day::date) AND {FREEZE_APPLIES})
+    )'''
+
+def record_daily_log(cursor, user_id, day):
+    '''
+    Update a user's streak for a daily log on `day`. The run continues when `day` follows the last
+    logged day (or the days between are all frozen) and restarts at 1 otherwise; the current length
+    is only kept if the run is still live today. Days at or before the last logged day change nothing.
+    Run it with the cursor that wrote the log, so the streak commits (or rolls back) with the write.
+    '''
+    cursor.execute("INSERT INTO streaks (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (user_id,))
+    cursor.execute(f'''
+        SELECT s.run_length, s.last_logged_date, {gap_frozen("s.last_logged_date", "%(day)s::date")}, {gap_frozen("%(day)s::date", "CURRENT_DATE")}
+        FROM streaks s JOIN users u ON u.id = s.user_id
+        WHERE s.user_id = %(user_id)s
+        FOR UPDATE OF s
+    ''', {"user_id": user_id, "day": day})
+    row = cursor.fetchone()
+    if row is None:
+        return
+    run_length, last_logged_date, continues, live = row
+    if last_logged_date is not None and day <= last_logged_date:
+        return
+    run_length = run_length + 1 if continues else 1
+    cursor.execute(
+        "UPDATE streaks SET run_length = %s, current_length = %s, longest_length = GREATEST(longest_length, %s), last_logged_date = %s, updated = NOW() WHERE user_id = %s",
+        (run_length, run_length if live else 0, run_length, day, user_id)
+    )
+
+def sweep_streaks(db):
+    '''
+    Break the streak of every user who did not log yesterday and was not frozen yesterday, so idle users
+    show a current length of 0 (their run_length is kept, see record_daily_log).
+    Meant to run once, shortly after midnight. Returns the number of streaks broken.
+    '''
+    with db.transaction() as cursor:
+        cursor.execute(f'''
+            UPDATE streaks SET current_length = 0, updated = NOW()
+            FROM users u
+            WHERE u.id = streaks.user_id
+            AND streaks.current_length > 0
+            AND streaks.last_logged_date < CURRENT_DATE - 1
+            AND NOT EXISTS (
+                SELECT 1 FROM streak_freezes f
+                WHERE f.starts <= CURRENT_DATE - 1 AND (f.ends IS NULL OR f.ends >= CURRENT_DATE - 1)
+                AND {FREEZE_APPLIES}
+            )
+        ''')
+        return cursor.rowcount
+
+def get_streak(db, user_id):
+    '''
+    Retrieve a user's streak and any freeze currently covering them, or None if the user does not exist.
+    '''
+    row = db.execute_query_fetchone(f'''
+        SELECT s.current_length, s.longest_length, s.last_logged_date, active.frozen, active.indefinite, active.until
+        FROM users u
+        LEFT JOIN streaks s ON s.user_id = u.id
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) > 0 AS frozen, bool_or(f.ends IS NULL) AS indefinite, MAX(f.ends) AS until
+            FROM streak_freezes f
+            WHERE f.starts <= CURRENT_DATE AND (f.ends IS NULL OR f.ends >= CURRENT_DATE)
+            AND {FREEZE_APPLIES}
+        ) active
+        WHERE u.id = %s
+    ''', (user_id,))
+    if row is None:
+        return None
+    current_length, longest_length, last_logged_date, frozen, indefinite, until = row
+    return {
+        "user_id": user_id,
+        "current": current_length or 0,
+        "longest": longest_length or 0,
+        "last_logged_date": last_logged_date.isoformat() if last_logged_date else None,
+        "frozen": frozen,
+        "frozen_until": None if indefinite or not frozen else until.isoformat()
+    }
+
+def freeze(db, scope, target_id, until, created_by):
+    '''
+    Freeze streaks for a user, a group or the whole org (target_id None) from today until `until`
+    (inclusive), or indefinitely if `until` is None. Returns the freeze id, or None if the target does not exist.
+    '''
+    match scope:
+        case 'user':
+            source = "SELECT 'user', id, %s, %s FROM users WHERE id = %s"
+        case 'group':
+            source = "SELECT 'group', id, %s, %s FROM groups WHERE id = %s"
+        case 'org':
+            source = "SELECT 'org', NULL::integer, %s, %s WHERE %s IS NULL"
+        case _:
+            raise ValueError("Invalid freeze scope")
+    row = db.execute_query_fetchone(f"INSERT INTO streak_freezes (scope, target_id, ends, created_by) {source} RETURNING id", (until, created_by, target_id))
+    return row[0] if row else None
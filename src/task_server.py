@@ -11,7 +11,9 @@
 # 0. System Imports
 import sys, os
 import time
-from datetime import datetime as dt
+import json, hashlib
+from datetime import datetime as dt, timedelta
+import pytz as tz
 
 # 1. Load .env file
 import dotenv
@@ -32,40 +34,72 @@ logger.info("Logging initialized at %s level", log_level)
 
 # 3. Celery
 from celery import Celery
+from celery.schedules import crontab
 logger.info("Initalising Celery...")
 logger.debug("Using broker URL: %s", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
 try:
-    celery = Celery("task_server", broker=os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+    # Results (and progress) of long jobs like roster syncs are kept in the result backend for the web server to read
+    celery = Celery(
+        "task_server",
+        broker=os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"),
+        backend=os.getenv("CELERY_RESULT_BACKEND", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+    )
 except Exception as e:
     logger.fatal("Could not initialize Celery: %s", e)
     sys.exit(1)
 
 # 4. Database
-if __name__ == '__main__':
-    import psycopg2 as pg
-    logger.info("Initalising Database connection...")
-    logger.debug("Using DB username: %s, password: %s, host: %s, port: %s, dbname: %s", 
-                 os.getenv("DB_USER", "postgres"),
-                 os.getenv("DB_PASSWORD", "password"),
-                 os.getenv("DB_HOST", "localhost"),
-                 os.getenv("DB_PORT", "5432"),
-                 os.getenv("DB_NAME", "athletemonitor")
-    )
-    try:
-        db_conn = pg.connect(
+# The pool is opened lazily in each process: prefork workers are forked from the main process,
+# and psycopg2 connections (sockets) must never be shared across a fork
+from db import Database, ConnectionPool
+
+class ProcessDatabase:
+    '''
+    Database whose connection pool belongs to the current process, created on first use.
+    '''
+    def __init__(self):
+        self._db = None
+        self._pid = None
+
+    def _connect(self):
+        logger.info("Initalising Database connection pool (pid %s)...", os.getpid())
+        logger.debug("Using DB username: %s, password: %s, host: %s, port: %s, dbname: %s, pool size: %s-%s", 
+                     os.getenv("DB_USER", "postgres"),
+                     os.getenv("DB_PASSWORD", "password"),
+                     os.getenv("DB_HOST", "localhost"),
+                     os.getenv("DB_PORT", "5432"),
+                     os.getenv("DB_NAME", "athletemonitor"),
+                     os.getenv("DB_POOL_MIN", "1"),
+                     os.getenv("DB_POOL_MAX", "10")
+        )
+        db_pool = ConnectionPool(
+            minconn=int(os.getenv("DB_POOL_MIN", "1")),
+            maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+            timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+            healthcheck_interval=float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30")),
             user=os.getenv("DB_USER", "postgres"),
             password=os.getenv("DB_PASSWORD", "password"),
             host=os.getenv("DB_HOST", "localhost"),
             port=os.getenv("DB_PORT", "5432"),
             dbname=os.getenv("DB_NAME", "athletemonitor")
         )
-        db_conn.autocommit = True
-    except Exception as e:
-        logger.fatal("Could not connect to Database: %s", e)
-        sys.exit(1)
-    logger.info("Database connection established.")
+        logger.info("Database connection pool established.")
+        return Database(db_pool)
+
+    def __getattr__(self, name):
+        if self._db is None or self._pid != os.getpid():
+            self._db = self._connect()
+            self._pid = os.getpid()
+        return getattr(self._db, name)
+
+db = ProcessDatabase()
 
 # 5. Task Definitions
+from analytics import cohort_stats
+import streaks
+import roster
+import schedules
+
 @celery.task()
 def example_task(x, y):
     logger.debug("Executing example_task with args: %s, %s", x, y)
@@ -74,7 +108,100 @@ def example_task(x, y):
     logger.debug("example_task result: %s", result)
     return result
 
+@celery.task()
+def maintain_log_partitions():
+    '''
+    Pre-create upcoming monthly log partitions, and archive old ones if LOG_PARTITION_RETAIN_MONTHS is set.
+    '''
+    created = db.ensure_log_partitions(int(os.getenv("LOG_PARTITION_MONTHS_AHEAD", "3")))
+    archived = []
+    retain_months = int(os.getenv("LOG_PARTITION_RETAIN_MONTHS", "0"))
+    if retain_months > 0:
+        archived = db.archive_log_partitions(retain_months)
+    logger.info("Log partition maintenance complete. Created: %s, archived: %s", created, archived)
+    return {"created": created, "archived": archived}
+
+@celery.task()
+def refresh_org_stats():
+    '''
+    Recalculate the org-wide stats snapshot served by /stats/org.
+    '''
+    days = int(os.getenv("ORG_STATS_DAYS", "28"))
+    today = dt.now(tz.timezone(os.getenv("TZ", "UTC"))).date()
+    students = db.execute_query_fetchall("SELECT id FROM users WHERE type = 'student'")
+    stats = cohort_stats(db, [row[0] for row in students], today - timedelta(days=days - 1), today + timedelta(days=1), per_athlete=False)
+    payload = json.dumps(stats, sort_keys=True)
+    etag = hashlib.sha256(payload.encode()).hexdigest()[:32]
+    db.execute_query(
+        "INSERT INTO stats_snapshots (scope, etag, generated_at, payload) VALUES ('org', %s, NOW(), %s) ON CONFLICT (scope) DO UPDATE SET etag = EXCLUDED.etag, generated_at = EXCLUDED.generated_at, payload = EXCLUDED.payload",
+        (etag, payload)
+    )
+    logger.info("Org stats snapshot refreshed (etag %s)", etag)
+    return etag
+
+@celery.task()
+def sweep_streaks():
+    '''
+    Break the streaks of users who missed yesterday's daily log and were not frozen.
+    '''
+    broken = streaks.sweep_streaks(db)
+    logger.info("Streak sweep complete. Broken: %s", broken)
+    return broken
+
+@celery.task()
+def materialize_schedules():
+    '''
+    Create the activities for each schedule's occurrences up to SCHEDULE_HORIZON_DAYS ahead (see schedules.materialize_schedules).
+    '''
+    created = schedules.materialize_schedules(db, int(os.getenv("SCHEDULE_HORIZON_DAYS", "14")))
+    logger.info("Schedule materialization complete. Created: %s", created)
+    return created
+
+@celery.task(bind=True)
+def sync_users(self, records, deactivate_missing=True, protect=(), dry_run=False):
+    '''
+    Apply a parsed roster to the users table (see roster.sync_roster), reporting progress as the PROGRESS state.
+    '''
+    def progress(done, total):
+        self.update_state(state='PROGRESS', meta={"done": done, "total": total})
+
+    summary = roster.sync_roster(
+        db, records,
+        deactivate_missing=deactivate_missing,
+        protect=protect,
+        dry_run=dry_run,
+        batch_size=int(os.getenv("ROSTER_SYNC_BATCH_SIZE", "500")),
+        progress=progress
+    )
+    user_ids = summary.pop("user_ids")
+    # Cached identities are only shared (and so only reachable from here) when the cache is in Redis
+    if user_ids and os.getenv("IDENTITY_CACHE_URL"):
+        from identity import IdentityCache
+        IdentityCache(db, redis_url=os.getenv("IDENTITY_CACHE_URL")).invalidate(*user_ids)
+    logger.info("Roster sync complete: %s", {key: value for key, value in summary.items() if key != "errors"})
+    return summary
+
+celery.conf.timezone = os.getenv("TZ", "UTC")
+celery.conf.beat_schedule = {
+    "refresh-org-stats": {
+        "task": "task_server.refresh_org_stats",
+        "schedule": int(os.getenv("ORG_STATS_REFRESH_SECONDS", "900"))
+    },
+    "maintain-log-partitions": {
+        "task": "task_server.maintain_log_partitions",
+        "schedule": 24 * 60 * 60
+    },
+    "sweep-streaks": {
+        "task": "task_server.sweep_streaks",
+        "schedule": crontab(hour=0, minute=5)
+    },
+    "materialize-schedules": {
+        "task": "task_server.materialize_schedules",
+        "schedule": crontab(minute=15)
+    }
+}
+
 # 6. Celery Startup
 if __name__ == '__main__':
     logger.info("Starting Celery worker...")
-    celery.start(['worker', '--loglevel=%s' % log_level.lower()])
\ No newline at end of file
+    celery.start(['worker', '--beat', '--loglevel=%s' % log_level.lower()])
\ No newline at end of file
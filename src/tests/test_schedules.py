@@ -0,0 +1,46 @@
+import datetime as dt
+import pytest
+from schedules import CronSchedule, parse_field, FIELDS
+
+DAY_OF_WEEK = FIELDS[4]
+
+def test_parse_field_lists_ranges_and_steps():
+    assert parse_field("1,15", *FIELDS[2]) == [1, 15]
+    assert parse_field("10-12", *FIELDS[1]) == [10, 11, 12]
+    assert parse_field("*/15", *FIELDS[0]) == [0, 15, 30, 45]
+    assert parse_field("5/20", *FIELDS[0]) == [5, 25, 45]
+
+def test_parse_field_name_ranges():
+    assert parse_field("mon-fri", *DAY_OF_WEEK) == [1, 2, 3, 4, 5]
+    assert parse_field("MON-FRI", *DAY_OF_WEEK) == [1, 2, 3, 4, 5]
+    assert parse_field("sat-sun", *DAY_OF_WEEK) == [6, 7]
+    assert parse_field("mon-sun", *DAY_OF_WEEK) == [1, 2, 3, 4, 5, 6, 7]
+    assert parse_field("jan-mar", *FIELDS[3]) == [1, 2, 3]
+
+@pytest.mark.parametrize("text, field", [("fri-mon", DAY_OF_WEEK), ("60", FIELDS[0]), ("*/0", FIELDS[0]), ("xyz", DAY_OF_WEEK)])
+def test_parse_field_rejects_invalid(text, field):
+    with pytest.raises(ValueError):
+        parse_field(text, *field)
+
+def test_restricted_day_fields_match_either():
+    schedule = CronSchedule("0 9 1 * mon")
+    assert schedule.matches_day(dt.date(2026, 10, 1))  # Thursday the 1st
+    assert schedule.matches_day(dt.date(2026, 10, 5))  # Monday the 5th
+    assert not schedule.matches_day(dt.date(2026, 10, 6))
+
+def test_star_prefixed_day_fields_match_both():
+    schedule = CronSchedule("0 9 */2 * mon")
+    assert schedule.matches_day(dt.date(2026, 10, 5))  # Monday, odd day
+    assert not schedule.matches_day(dt.date(2026, 10, 12))  # Monday, even day
+    assert not schedule.matches_day(dt.date(2026, 10, 7))  # odd day, Wednesday
+
+def test_weekday_schedule_occurrences():
+    schedule = CronSchedule("30 9 * * mon-fri")
+    occurrences = list(schedule.occurrences(dt.datetime(2026, 10, 16), dt.datetime(2026, 10, 20)))
+    assert occurrences == [dt.datetime(2026, 10, 16, 9, 30), dt.datetime(2026, 10, 19, 9, 30)]
+
+def test_never_matching_expression_is_rejected():
+    with pytest.raises(ValueError):
+        CronSchedule("0 0 30 2 *")
+    with pytest.raises(ValueError):
+        CronSchedule("0 0 30 2 */2")
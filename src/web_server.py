@@ -4,14 +4,15 @@
 # 1. Load .env file
 # 2. Logging
 # 3. Celery
-# 4. Database
-# 5. Flask
-# 6. Blueprints
+# 4. Password Hashing
+# 5. Database
+# 6. Flask
+# 7. Blueprints
 
 # 0. System Imports
 import sys, os
 import time
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 import pytz as tz
 import utils
 from responses import Responses
@@ -36,35 +37,78 @@ logger.info("Logging initialized at %s level", log_level)
 # 3. Celery
 import task_server as ts
 
-# 4. Database
-import psycopg2 as pg
-logger.info("Initalising Database connection...")
-logger.debug("Using DB username: %s, password: %s, host: %s, port: %s, dbname: %s", 
+# 4. Password Hashing
+# Forked before the database pool opens, so the workers don't inherit its sockets
+from passwords import PasswordHasher
+hash_workers = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+hasher = PasswordHasher(
+    workers=hash_workers,
+    max_pending=int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(max(hash_workers, 1) * 4))),
+    timeout=float(os.getenv("PASSWORD_HASH_TIMEOUT", "5"))
+)
+logger.info("Password hashing pool started with %s workers.", hash_workers)
+
+# 5. Database
+from db import Database, ConnectionPool
+logger.info("Initalising Database connection pool...")
+logger.debug("Using DB username: %s, password: %s, host: %s, port: %s, dbname: %s, pool size: %s-%s", 
              os.getenv("DB_USER", "postgres"),
              os.getenv("DB_PASSWORD", "password"),
              os.getenv("DB_HOST", "localhost"),
              os.getenv("DB_PORT", "5432"),
-             os.getenv("DB_NAME", "athletemonitor")
+             os.getenv("DB_NAME", "athletemonitor"),
+             os.getenv("DB_POOL_MIN", "1"),
+             os.getenv("DB_POOL_MAX", "10")
 )
 try:
-    db_conn = pg.connect(
+    db_pool = ConnectionPool(
+        minconn=int(os.getenv("DB_POOL_MIN", "1")),
+        maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+        timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        healthcheck_interval=float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30")),
         user=os.getenv("DB_USER", "postgres"),
         password=os.getenv("DB_PASSWORD", "password"),
         host=os.getenv("DB_HOST", "localhost"),
         port=os.getenv("DB_PORT", "5432"),
         dbname=os.getenv("DB_NAME", "athletemonitor")
     )
-    db_conn.autocommit = True
 except Exception as e:
     logger.fatal("Could not connect to Database: %s", e)
     sys.exit(1)
 
-from db import Database
-db = Database(db_conn)
-db.database_table_constructor()
-logger.info("Database connection established.")
+db = Database(db_pool)
+db.migrate()
+logger.info("Database connection pool established.")
+
+from log_query import check_index_plans
+check_index_plans(db)
+
+from identity import IdentityCache
+identities = IdentityCache(
+    db,
+    ttl=float(os.getenv("IDENTITY_CACHE_TTL", "60")),
+    redis_url=os.getenv("IDENTITY_CACHE_URL")
+)
+
+from ratelimit import RateLimiter, parse_limit
+limiter = RateLimiter(
+    limits={
+        "login": parse_limit(os.getenv("RATE_LIMIT_LOGIN", "120/60")),
+        "login_user": parse_limit(os.getenv("RATE_LIMIT_LOGIN_USER", "10/300")),
+        "register": parse_limit(os.getenv("RATE_LIMIT_REGISTER", "20/3600")),
+        "log_writes": parse_limit(os.getenv("RATE_LIMIT_LOG_WRITES", "600/600"))
+    },
+    redis_url=os.getenv("RATE_LIMIT_URL", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+)
+
+from revocation import RevocationList
+revocations = RevocationList(
+    redis_url=os.getenv("REVOCATION_URL", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")),
+    capacity=int(os.getenv("REVOCATION_BLOOM_CAPACITY", "100000")),
+    sync_interval=float(os.getenv("REVOCATION_SYNC_SECONDS", "60"))
+)
 
-# 5. Flask init
+# 6. Flask init
 logger.info("Initalising Flask web server...")
 from flask import Flask, jsonify
 app = Flask(__name__)
@@ -73,12 +117,14 @@ app.config['APP_NAME'] = 'ADP Athlete Monitor'
 app.config['VERSION'] = '0.0.1'
 app.config['SECRET_KEY'] = os.getenv("APP_SECRET_KEY", "secret")
 app.config['TZ_OBJ'] = tz.timezone(os.getenv("TZ", "UTC"))
+app.config['ACCESS_TOKEN_LIFETIME'] = timedelta(minutes=int(os.getenv("ACCESS_TOKEN_MINUTES", "15")))
+app.config['REFRESH_TOKEN_LIFETIME'] = timedelta(days=int(os.getenv("REFRESH_TOKEN_DAYS", "30")))
 
-from blueprints.auth import require_authentication, require_type, current_user, register
+from blueprints.auth import require_authentication, require_type, rate_limit, current_user, current_identity, register
 
 logger.info("Flask web server initialized.")
 
-# 6. Blueprints
+# 7. Blueprints
 import blueprints as bp
 import importlib
 
@@ -91,7 +137,7 @@ for module_name in bp.modules:
         logger.error("Could not register blueprint %s: %s", module_name, e)
 logger.info("All blueprints registered.")
 
-# 7. Root routes (lol)
+# 8. Root routes (lol)
 @app.route('/', methods=['GET'])
 def index():
     return Responses.OK_200(data={